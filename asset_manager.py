@@ -0,0 +1,115 @@
+"""
+
+Static assets that a bot attaches to its responses, such as the video of VideoBot.
+
+Each asset is memory-mapped and hashed once, when the container starts. After an asset
+has been uploaded for the first time, later responses attach it again by the URL of the
+uploaded attachment, so its bytes are not read or sent again for every request.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import mmap
+import os
+from dataclasses import dataclass, field
+
+import fastapi_poe as fp
+
+from attachment_upload import StreamingUploadBot
+
+
+@dataclass
+class Asset:
+    path: str
+    filename: str
+    size: int
+    sha256: str
+    upload_lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+
+def _hash_file(path: str) -> tuple[int, str]:
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return 0, hashlib.sha256().hexdigest()
+        # The page cache backs the mapping, so the file is not copied into memory.
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return size, hashlib.sha256(mapped).hexdigest()
+
+
+class AssetManager:
+    """Loads static assets once per container and reuses their uploaded attachments."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.assets: dict[str, Asset] = {}
+        # URL of the uploaded attachment, by content hash.
+        self.attachment_urls: dict[str, str] = {}
+        self.uploads = 0
+        self.reuses = 0
+
+    def load(self, filename: str) -> Asset:
+        asset = self.assets.get(filename)
+        if asset is None:
+            path = os.path.join(self.directory, filename)
+            size, sha256 = _hash_file(path)
+            asset = Asset(path=path, filename=filename, size=size, sha256=sha256)
+            self.assets[filename] = asset
+        return asset
+
+    async def post_attachment(
+        self, bot: fp.PoeBot, message_id: str, filename: str, *, is_inline: bool = False
+    ) -> fp.AttachmentUploadResponse:
+        """Attaches an asset to a message, uploading its bytes only the first time."""
+        asset = self.load(filename)
+        attachment_url = self.attachment_urls.get(asset.sha256)
+        if attachment_url is None:
+            # Concurrent first requests wait for a single upload instead of all uploading.
+            async with asset.upload_lock:
+                attachment_url = self.attachment_urls.get(asset.sha256)
+                if attachment_url is None:
+                    return await self._upload(bot, message_id, asset, is_inline)
+
+        try:
+            response = await bot.post_message_attachment(
+                message_id=message_id,
+                download_url=attachment_url,
+                download_filename=asset.filename,
+                is_inline=is_inline,
+            )
+        except Exception:
+            # The uploaded attachment is no longer available, so upload it again.
+            self.attachment_urls.pop(asset.sha256, None)
+            return await self._upload(bot, message_id, asset, is_inline)
+        self.reuses += 1
+        return response
+
+    async def _upload(
+        self, bot: fp.PoeBot, message_id: str, asset: Asset, is_inline: bool
+    ) -> fp.AttachmentUploadResponse:
+        if isinstance(bot, StreamingUploadBot):
+            response = await bot.post_streaming_attachment(
+                message_id, asset.path, asset.filename, is_inline=is_inline
+            )
+        else:
+            with open(asset.path, "rb") as file:
+                response = await bot.post_message_attachment(
+                    message_id=message_id,
+                    file_data=file,
+                    filename=asset.filename,
+                    is_inline=is_inline,
+                )
+        self.uploads += 1
+        if response.attachment_url:
+            self.attachment_urls[asset.sha256] = response.attachment_url
+        return response
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "assets": len(self.assets),
+            "uploads": self.uploads,
+            "reuses": self.reuses,
+        }
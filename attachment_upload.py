@@ -0,0 +1,225 @@
+"""
+
+Chunked streaming uploads of attachments.
+
+`fp.PoeBot.post_message_attachment` reads the whole file into memory and builds the
+multipart request body around it, so uploading a file takes about twice its size in
+memory. Bots that subclass `StreamingUploadBot` instead stream the file to the attachment
+endpoint in chunks of UPLOAD_CHUNK_SIZE bytes, from a file path, a file object, an async
+iterator of bytes or an in-memory buffer, with at most MAX_CONCURRENT_UPLOADS uploads at a
+time per container.
+
+Uploads go to the `base_url` passed to `post_message_attachment`. When none is passed,
+they go to POE_UPLOAD_BASE_URL if it is set, so the endpoint can be pointed at a local
+stand-in server.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import uuid
+from typing import IO, AsyncIterable, AsyncIterator, Optional, Union
+
+import fastapi_poe as fp
+import httpx
+from fastapi_poe.base import POE_API_WEBSERVER_BASE_URL
+from fastapi_poe.client import AttachmentUploadError
+
+UPLOAD_BASE_URL = os.getenv("POE_UPLOAD_BASE_URL", POE_API_WEBSERVER_BASE_URL)
+UPLOAD_CHUNK_SIZE = 256 * 1024
+MAX_CONCURRENT_UPLOADS = 4
+UPLOAD_TIMEOUT = 120.0
+UPLOAD_NUM_TRIES = 2
+
+UploadSource = Union[
+    str,
+    "os.PathLike[str]",
+    bytes,
+    bytearray,
+    memoryview,
+    IO[bytes],
+    AsyncIterable[bytes],
+]
+
+
+def _source_size(source: UploadSource) -> Optional[int]:
+    """Returns the number of bytes the source will produce, if it is known up front."""
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source).nbytes
+    if hasattr(source, "read") and hasattr(source, "seek"):
+        try:
+            start = source.tell()
+            end = source.seek(0, os.SEEK_END)
+            source.seek(start)
+            return end - start
+        except (OSError, ValueError):
+            return None
+    return None
+
+
+def _is_replayable(source: UploadSource) -> bool:
+    return isinstance(source, (str, os.PathLike, bytes, bytearray, memoryview))
+
+
+async def _read_file_chunks(file: IO[bytes], chunk_size: int) -> AsyncIterator[bytes]:
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, file.read, chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def iter_chunks(
+    source: UploadSource, chunk_size: int = UPLOAD_CHUNK_SIZE
+) -> AsyncIterator[bytes]:
+    """Yields the bytes of the source in chunks of at most `chunk_size` bytes."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as file:
+            async for chunk in _read_file_chunks(file, chunk_size):
+                yield chunk
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast("B")
+        for start in range(0, view.nbytes, chunk_size):
+            end = start + chunk_size
+            yield bytes(view[start:end])
+    elif hasattr(source, "read"):
+        async for chunk in _read_file_chunks(source, chunk_size):
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+class AttachmentUploader:
+    """Streams attachments to the attachment endpoint over a pooled HTTP client."""
+
+    def __init__(
+        self,
+        base_url: str = UPLOAD_BASE_URL,
+        max_concurrent_uploads: int = MAX_CONCURRENT_UPLOADS,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ) -> None:
+        self.base_url = base_url
+        self.chunk_size = chunk_size
+        self.semaphore = asyncio.Semaphore(max_concurrent_uploads)
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def upload(
+        self,
+        source: UploadSource,
+        filename: str,
+        api_key: str,
+        base_url: Optional[str] = None,
+    ) -> fp.Attachment:
+        """Uploads to `base_url`, or to the base url of the uploader if it's not given."""
+        endpoint = (base_url or self.base_url).rstrip(
+            "/"
+        ) + "/file_upload_3RD_PARTY_POST"
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=UPLOAD_TIMEOUT)
+        # Sources that are consumed while they are sent cannot be sent again.
+        num_tries = UPLOAD_NUM_TRIES if _is_replayable(source) else 1
+        async with self.semaphore:
+            for _ in range(num_tries - 1):
+                try:
+                    return await self._upload_once(endpoint, source, filename, api_key)
+                except (httpx.HTTPError, AttachmentUploadError):
+                    pass
+            return await self._upload_once(endpoint, source, filename, api_key)
+
+    async def _upload_once(
+        self, endpoint: str, source: UploadSource, filename: str, api_key: str
+    ) -> fp.Attachment:
+        assert self.client is not None
+        boundary = uuid.uuid4().hex
+        quoted_filename = filename.replace("\\", "\\\\").replace('"', '\\"')
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{quoted_filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+
+        async def body() -> AsyncIterator[bytes]:
+            yield head
+            async for chunk in iter_chunks(source, self.chunk_size):
+                yield chunk
+            yield tail
+
+        headers = {
+            "Authorization": api_key,
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+        }
+        size = _source_size(source)
+        if size is not None:
+            headers["Content-Length"] = str(len(head) + size + len(tail))
+        response = await self.client.post(endpoint, content=body(), headers=headers)
+        if response.status_code != 200:
+            raise AttachmentUploadError(
+                f"{response.status_code} {response.reason_phrase}: {response.text}"
+            )
+        data = response.json()
+        if "attachment_url" not in data or "mime_type" not in data:
+            raise AttachmentUploadError(f"Unexpected response format: {data}")
+        return fp.Attachment(
+            url=data["attachment_url"], content_type=data["mime_type"], name=filename
+        )
+
+    async def aclose(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+class StreamingUploadBot(fp.PoeBot):
+    """A PoeBot whose `post_message_attachment` streams `file_data` in chunks."""
+
+    # Shared by all requests to this container. Created on first use if not set when the
+    # app starts up.
+    uploader: Optional[AttachmentUploader] = None
+
+    async def post_streaming_attachment(
+        self,
+        message_id: str,
+        source: UploadSource,
+        filename: str,
+        *,
+        is_inline: bool = False,
+    ) -> fp.AttachmentUploadResponse:
+        """Attaches a file path, file object, async iterator of bytes or buffer."""
+        return await self.post_message_attachment(
+            message_id=message_id,
+            file_data=source,  # type: ignore[arg-type]
+            filename=filename,
+            is_inline=is_inline,
+        )
+
+    async def _upload_file(
+        self,
+        *,
+        file: Optional[UploadSource],
+        file_url: Optional[str],
+        file_name: Optional[str],
+        api_key: str,
+        base_url: str,
+    ) -> fp.Attachment:
+        if self.uploader is None:
+            self.uploader = AttachmentUploader()
+        # post_message_attachment passes the default of fastapi_poe when the caller didn't
+        # choose a base url, in which case the base url of the uploader applies.
+        if base_url == POE_API_WEBSERVER_BASE_URL:
+            base_url = self.uploader.base_url
+        if file is None or file_url is not None:
+            return await super()._upload_file(
+                file=file,  # type: ignore[arg-type]
+                file_url=file_url,
+                file_name=file_name,
+                api_key=api_key,
+                base_url=base_url,
+            )
+        return await self.uploader.upload(file, file_name or "file", api_key, base_url)
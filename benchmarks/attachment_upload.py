@@ -0,0 +1,143 @@
+"""
+
+Compares uploading an attachment with `fp.upload_file`, which is what
+`post_message_attachment` uses, against the chunked streaming upload of
+attachment_upload.py. Both upload to a local stand-in for the attachment endpoint, which
+checks the content it receives.
+
+Run from the root of the repo with `python -m benchmarks.attachment_upload`.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import AsyncIterator, Awaitable, Callable
+
+import fastapi_poe as fp
+
+from attachment_upload import AttachmentUploader
+
+
+class StandInUploadHandler(BaseHTTPRequestHandler):
+    """Accepts multipart uploads, answering with the sha256 of the file in the URL."""
+
+    def read_body(self) -> bytes:
+        if "Content-Length" in self.headers:
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if size == 0:
+                return b"".join(chunks)
+
+    def do_POST(self) -> None:
+        body = self.read_body()
+        boundary = self.headers["Content-Type"].split("boundary=")[1].encode()
+        part = body.split(b"--" + boundary)[1]
+        headers, _, content = part.partition(b"\r\n\r\n")
+        content = content[:-2]  # The line break before the next boundary.
+        digest = hashlib.sha256(content).hexdigest()
+        response = json.dumps(
+            {
+                "attachment_url": f"http://localhost/{digest}",
+                "mime_type": "application/octet-stream",
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def serve(port: int) -> None:
+    ThreadingHTTPServer(("127.0.0.1", port), StandInUploadHandler).serve_forever()
+
+
+async def measure(
+    upload: Callable[[], Awaitable[fp.Attachment]]
+) -> tuple[fp.Attachment, float, int]:
+    """Returns the attachment, the time taken and the peak python memory allocated."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    attachment = await upload()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return attachment, elapsed, peak
+
+
+async def file_chunks(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b""):
+            yield chunk
+
+
+async def run(sizes: list[int], port: int) -> None:
+    base_url = f"http://127.0.0.1:{port}/"
+    uploader = AttachmentUploader(base_url=base_url)
+
+    async def upload_with_fastapi_poe(path: str) -> fp.Attachment:
+        with open(path, "rb") as file:
+            return await fp.upload_file(
+                file=file, file_name="file.bin", api_key="key", base_url=base_url
+            )
+
+    print(f"{'file MB':>8} {'method':>16} {'seconds':>9} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f"{size}.bin")
+            digest = hashlib.sha256()
+            with open(path, "wb") as f:
+                for _ in range(size):
+                    chunk = os.urandom(2**20)
+                    digest.update(chunk)
+                    f.write(chunk)
+            expected_url = f"http://localhost/{digest.hexdigest()}"
+
+            for name, upload in [
+                ("fp.upload_file", lambda: upload_with_fastapi_poe(path)),
+                ("streaming path", lambda: uploader.upload(path, "file.bin", "key")),
+                (
+                    "streaming iter",
+                    lambda: uploader.upload(file_chunks(path), "file.bin", "key"),
+                ),
+            ]:
+                attachment, elapsed, peak = await measure(upload)
+                assert attachment.url == expected_url, name
+                print(f"{size:>8} {name:>16} {elapsed:>9.3f} {peak / 2**20:>8.1f}")
+    await uploader.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--port", type=int, default=8731)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=serve, args=(args.port,), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    try:
+        asyncio.run(run(args.sizes, args.port))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+
+Load tests the OpenAI provider layer of WrapperBot against a local stand-in for an
+OpenAI-compatible chat completions endpoint, without network access. The stand-in fails
+some requests before streaming anything and is slow to start some others, to compare the
+tail latency with and without retries and hedged requests.
+
+Run from the root of the repo with `python -m benchmarks.openai_provider`.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import statistics
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from openai_provider import OpenAIProvider
+
+
+def make_handler(
+    fail_rate: float, slow_rate: float, slow_delay: float, num_chunks: int
+) -> type[BaseHTTPRequestHandler]:
+    class StandInChatHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self) -> None:
+            self.rfile.read(int(self.headers["Content-Length"]))
+            roll = random.random()
+            if roll < fail_rate:
+                body = b'{"error": {"message": "overloaded"}}'
+                self.send_response(500)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(slow_delay if roll < fail_rate + slow_rate else 0.02)
+            try:
+                for i in range(num_chunks):
+                    chunk = {
+                        "id": "chatcmpl-0",
+                        "object": "chat.completion.chunk",
+                        "created": 0,
+                        "model": "stand-in",
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": {"content": f"t{i} "},
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                    self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                    time.sleep(0.005)
+                self.write_chunk(b"data: [DONE]\n\n")
+                self.write_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # The losing request of a hedged pair is closed by the client.
+                self.close_connection = True
+
+        def write_chunk(self, data: bytes) -> None:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    return StandInChatHandler
+
+
+def serve(port: int, *handler_args: float) -> None:
+    handler = make_handler(*handler_args)  # type: ignore[arg-type]
+    ThreadingHTTPServer(("127.0.0.1", port), handler).serve_forever()
+
+
+async def run_one(provider: OpenAIProvider) -> Optional[float]:
+    """Returns the time to first token, or None if the request failed."""
+    start = time.perf_counter()
+    first_token = None
+    try:
+        async for _ in provider.stream_chat_completion(
+            model="stand-in", messages=[{"role": "user", "content": "hi"}]
+        ):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+    except Exception:
+        return None
+    return first_token
+
+
+async def run(
+    port: int, num_requests: int, concurrency: int, hedge_delay: Optional[float]
+) -> str:
+    provider = OpenAIProvider(
+        base_url=f"http://127.0.0.1:{port}/v1",
+        api_key="unused",
+        hedge_delay=hedge_delay,
+        first_token_timeout=5.0,
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited() -> Optional[float]:
+        async with semaphore:
+            return await run_one(provider)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited() for _ in range(num_requests)))
+    elapsed = time.perf_counter() - start
+    await provider.aclose()
+
+    latencies = sorted(r for r in results if r is not None)
+    quantiles = statistics.quantiles(latencies, n=100)
+    return (
+        f"{str(hedge_delay):>6} {quantiles[49] * 1000:>8.0f} {quantiles[94] * 1000:>8.0f} "
+        f"{quantiles[98] * 1000:>8.0f} {num_requests - len(latencies):>7} "
+        f"{provider.stats['retries']:>8} {provider.stats['hedges']:>7} {elapsed:>8.2f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--fail-rate", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-delay", type=float, default=2.0)
+    parser.add_argument("--port", type=int, default=8733)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(
+        target=serve,
+        args=(args.port, args.fail_rate, args.slow_rate, args.slow_delay, 20),
+        daemon=True,
+    )
+    server.start()
+    time.sleep(0.5)
+    try:
+        print(
+            f"{'hedge':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} "
+            f"{'retries':>8} {'hedges':>7} {'seconds':>8}"
+        )
+        for hedge_delay in [None, 0.25]:
+            print(
+                asyncio.run(
+                    run(args.port, args.requests, args.concurrency, hedge_delay)
+                )
+            )
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
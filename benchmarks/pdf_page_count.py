@@ -0,0 +1,116 @@
+"""
+
+Compares pdf_page_count.count_pages with parsing the whole pdf with PyPDF2, on synthetic
+pdfs with many large pages. Each size is written with its page count both inline and as a
+reference to another object, which is also valid.
+
+Run from the root of the repo with `python -m benchmarks.pdf_page_count`.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+from PyPDF2 import PdfReader
+
+from pdf_page_count import count_pages
+
+
+def write_synthetic_pdf(
+    path: str, num_pages: int, page_size: int, indirect_count: bool = False
+) -> None:
+    """Writes a pdf with `num_pages` pages, each with a `page_size` bytes content stream.
+
+    With `indirect_count`, the /Count of the page tree is a reference to an integer object.
+
+    """
+    offsets: list[int] = []
+    with open(path, "wb") as f:
+
+        def write_object(body: bytes) -> None:
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % len(offsets) + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        write_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = b" ".join(b"%d 0 R" % (3 + 2 * i) for i in range(num_pages))
+        count = b"%d 0 R" % (3 + 2 * num_pages) if indirect_count else b"%d" % num_pages
+        write_object(b"<< /Type /Pages /Kids [%s] /Count %s >>" % (kids, count))
+        content = b"% " + b"x" * (page_size - 3) + b"\n"
+        for i in range(num_pages):
+            write_object(
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R >>"
+                % (4 + 2 * i)
+            )
+            write_object(
+                b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+            )
+        if indirect_count:
+            write_object(b"%d" % num_pages)
+
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f\r\n" % (len(offsets) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n\r\n" % offset)
+        f.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(offsets) + 1, xref_offset)
+        )
+
+
+def count_pages_with_pypdf2(path: str) -> int:
+    # This mirrors the previous implementation, which buffered the whole download.
+    with open(path, "rb") as f:
+        data = f.read()
+    return len(PdfReader(io.BytesIO(data)).pages)
+
+
+def measure(function: Callable[[str], int], path: str) -> tuple[int, float, int]:
+    """Returns the result, the time taken and the peak python memory allocated."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(path)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1000, 10000, 20000])
+    parser.add_argument("--page-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    print(
+        f"{'pages':>8} {'/Count':>8} {'file MB':>8} {'engine':>10} {'seconds':>9} "
+        f"{'peak MB':>8}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for num_pages in args.pages:
+            for indirect_count in [False, True]:
+                count_kind = "indirect" if indirect_count else "direct"
+                path = os.path.join(directory, f"{num_pages}-{count_kind}.pdf")
+                write_synthetic_pdf(path, num_pages, args.page_size, indirect_count)
+                file_size = os.path.getsize(path) / 2**20
+                for name, function in [
+                    ("PyPDF2", count_pages_with_pypdf2),
+                    ("xref", count_pages),
+                ]:
+                    result, elapsed, peak = measure(function, path)
+                    assert result == num_pages, (name, count_kind, result)
+                    print(
+                        f"{num_pages:>8} {count_kind:>8} {file_size:>8.1f} {name:>10} "
+                        f"{elapsed:>9.4f} {peak / 2**20:>8.1f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
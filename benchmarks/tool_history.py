@@ -0,0 +1,132 @@
+"""
+
+Compares expanding the stored tool history of FunctionCallingLoopBot with the previous
+plain JSON metadata against the versioned encoding and the per-conversation cache.
+
+Run from the root of the repo with `python -m benchmarks.tool_history`.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from typing import Callable
+
+import fastapi_poe as fp
+
+from tool_history import ToolHistoryCache, encode_tool_messages
+
+
+def make_tool_messages(turn: int) -> list[fp.ProtocolMessage]:
+    tool_call = {
+        "id": f"call_{turn}",
+        "type": "function",
+        "function": {
+            "name": "get_weather",
+            "arguments": json.dumps({"latitude": 48.85, "longitude": 2.35}),
+        },
+    }
+    tool_result = {
+        "role": "tool",
+        "name": "get_weather",
+        "tool_call_id": f"call_{turn}",
+        "content": "21.3",
+    }
+    return [
+        fp.ProtocolMessage(
+            role="bot", message_type="function_call", content=json.dumps([tool_call])
+        ),
+        fp.ProtocolMessage(role="tool", content=json.dumps([tool_result])),
+    ]
+
+
+def make_request(
+    num_turns: int, encode: Callable[[list[fp.ProtocolMessage]], str]
+) -> fp.QueryRequest:
+    query = []
+    for turn in range(num_turns):
+        query.append(
+            fp.ProtocolMessage(
+                role="user", content="What's the weather?", message_id=f"u{turn}"
+            )
+        )
+        query.append(
+            fp.ProtocolMessage(
+                role="bot",
+                content="It is 21.3 degrees.",
+                message_id=f"b{turn}",
+                metadata=encode(make_tool_messages(turn)),
+            )
+        )
+    query.append(fp.ProtocolMessage(role="user", content="And now?"))
+    return fp.QueryRequest(
+        version="1.0",
+        type="query",
+        query=query,
+        user_id="user",
+        conversation_id="conversation",
+        message_id="message",
+    )
+
+
+def expand_legacy(request: fp.QueryRequest) -> list[fp.ProtocolMessage]:
+    # This mirrors the previous implementation in FunctionCallingLoopBot.get_response.
+    expanded: list[fp.ProtocolMessage] = []
+    for msg in request.query:
+        if msg.metadata is not None:
+            expanded.extend(
+                fp.ProtocolMessage.model_validate(message_dict)
+                for message_dict in json.loads(msg.metadata)
+            )
+        expanded.append(msg.model_copy(update={"metadata": None}))
+    return expanded
+
+
+def encode_legacy(messages: list[fp.ProtocolMessage]) -> str:
+    return json.dumps([message.model_dump() for message in messages])
+
+
+def time_per_call(function: Callable[[], object], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(
+        f"{'turns':>6} {'legacy ms':>10} {'v1 cold ms':>11} {'v1 warm ms':>11} "
+        f"{'legacy KB':>10} {'v1 KB':>8}"
+    )
+    for num_turns in args.turns:
+        legacy_request = make_request(num_turns, encode_legacy)
+        request = make_request(num_turns, encode_tool_messages)
+        assert len(expand_legacy(legacy_request)) == len(
+            ToolHistoryCache(1).expand_query(request)
+        )
+
+        legacy = time_per_call(lambda: expand_legacy(legacy_request), args.repeat)
+        cold = time_per_call(
+            lambda: ToolHistoryCache(1).expand_query(request), args.repeat
+        )
+        warm_cache = ToolHistoryCache(1)
+        warm_cache.expand_query(request)
+        warm = time_per_call(lambda: warm_cache.expand_query(request), args.repeat)
+
+        legacy_size = sum(len(m.metadata or "") for m in legacy_request.query) / 1024
+        size = sum(len(m.metadata or "") for m in request.query) / 1024
+        print(
+            f"{num_turns:>6} {legacy * 1000:>10.2f} {cold * 1000:>11.2f} "
+            f"{warm * 1000:>11.2f} {legacy_size:>10.1f} {size:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
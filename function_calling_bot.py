@@ -13,12 +13,18 @@ from typing import AsyncIterable
 import fastapi_poe as fp
 from modal import App, Image, asgi_app
 
+from tool_cache import cached_tool, get_tool_cache_stats
+
 # TODO: set your bot access key and bot name for this bot to work
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
 bot_name = ""
 
+# Weather results are cached for this many seconds, see tool_cache.py
+WEATHER_CACHE_TTL = 10 * 60
+
 
+@cached_tool(ttl=WEATHER_CACHE_TTL)
 def get_current_weather(location, unit="fahrenheit"):
     """Get the current weather in a given location"""
     if "tokyo" in location.lower():
@@ -94,4 +100,9 @@ def fastapi_app():
         bot_name=bot_name,
         allow_without_key=not (bot_access_key and bot_name),
     )
+
+    @app.get("/tool_cache_stats")
+    async def tool_cache_stats() -> dict:
+        return get_tool_cache_stats()
+
     return app
@@ -1,11 +1,18 @@
+import asyncio
+import functools
+import inspect
 import json
 import os
 from typing import AsyncIterable
 
 import fastapi_poe as fp
-import requests
+import httpx
+from fastapi_poe.types import ToolCallDefinitionDelta
 from modal import App, Image, asgi_app
 
+from tool_cache import cached_tool, get_tool_cache_stats
+from tool_history import compact_tool_context, encode_tool_messages, tool_history_cache
+
 # TODO: set your bot access key and bot name for this bot to work
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
@@ -13,16 +20,29 @@ bot_name = ""
 
 TOOL_CALL_BOT = "GPT-4o"
 MAX_BOT_CALLS = 10
+# Approximate token budget for the context sent to the model. Once it is exceeded, older
+# tool calls and results are collapsed into short summaries, except for the most recent
+# KEEP_RECENT_TOOL_EXCHANGES ones.
+CONTEXT_TOKEN_BUDGET = 8000
+KEEP_RECENT_TOOL_EXCHANGES = 4
+
+
+# Tools can be either sync or async functions. Sync tools are run in a thread pool.
+DEFAULT_TOOL_TIMEOUT = 30.0
+# Weather results are cached for this many seconds, see tool_cache.py
+WEATHER_CACHE_TTL = 10 * 60
 
 
 # Define a list of callable tools for the model
-def get_weather(latitude: float, longitude: float) -> float:
-    response = requests.get(
-        "https://api.open-meteo.com/v1/forecast?"
-        f"latitude={latitude}&longitude={longitude}"
-        "&current=temperature_2m,wind_speed_10m&hourly=temperature_2m,"
-        "relative_humidity_2m,wind_speed_10m"
-    )
+@cached_tool(ttl=WEATHER_CACHE_TTL)
+async def get_weather(latitude: float, longitude: float) -> float:
+    async with httpx.AsyncClient() as client:
+        response = await client.get(
+            "https://api.open-meteo.com/v1/forecast?"
+            f"latitude={latitude}&longitude={longitude}"
+            "&current=temperature_2m,wind_speed_10m&hourly=temperature_2m,"
+            "relative_humidity_2m,wind_speed_10m"
+        )
     data = response.json()
     return data["current"]["temperature_2m"]
 
@@ -47,47 +67,139 @@ tools_dicts = [
     }
 ]
 tool_executables_map = {"get_weather": get_weather}
+# Timeouts in seconds for tools that need a different one than DEFAULT_TOOL_TIMEOUT
+tool_timeouts = {"get_weather": 10.0}
 tool_definitions = [fp.ToolDefinition(**tools_dict) for tools_dict in tools_dicts]
 
 
-def get_tool_call_result(tool_call: fp.ToolCallDefinition) -> fp.ToolResultDefinition:
+async def get_tool_call_result(
+    tool_call: fp.ToolCallDefinition,
+) -> fp.ToolResultDefinition:
     """Execute the tool and return the result wrapped in a ToolResultDefinition"""
     tool_name = tool_call.function.name
     tool_args = json.loads(tool_call.function.arguments)
     tool_function = tool_executables_map[tool_name]
 
-    result = tool_function(**tool_args)
+    if inspect.iscoroutinefunction(tool_function):
+        pending_result = tool_function(**tool_args)
+    else:
+        loop = asyncio.get_running_loop()
+        pending_result = loop.run_in_executor(
+            None, functools.partial(tool_function, **tool_args)
+        )
+    timeout = tool_timeouts.get(tool_name, DEFAULT_TOOL_TIMEOUT)
+    try:
+        result = await asyncio.wait_for(pending_result, timeout=timeout)
+    except asyncio.TimeoutError:
+        result = f"Error: {tool_name} did not finish within {timeout} seconds."
     return fp.ToolResultDefinition(
         role="tool", name=tool_name, tool_call_id=tool_call.id, content=str(result)
     )
 
 
+class ToolCallAssembler:
+    """Assembles streamed tool call deltas, dispatching each call as soon as it is complete.
+
+    The arguments of each call are buffered as a list of chunks, and a small scanner tracks
+    the nesting of the JSON object as the chunks arrive. Once the top level object closes
+    and parses, the call is complete and its tool is started right away, while the model
+    is still streaming the remaining calls.
+
+    """
+
+    def __init__(self) -> None:
+        self.calls: dict[int, fp.ToolCallDefinition] = {}
+        self.argument_chunks: dict[int, list[str]] = {}
+        self.tasks: dict[int, asyncio.Future[fp.ToolResultDefinition]] = {}
+        self._depth: dict[int, int] = {}
+        self._in_string: dict[int, bool] = {}
+        self._escaped: dict[int, bool] = {}
+
+    def add(self, delta: ToolCallDefinitionDelta) -> None:
+        index = delta.index
+        if index not in self.calls:
+            self.calls[index] = fp.ToolCallDefinition(
+                id=delta.id or "",
+                type=delta.type or "function",
+                function={"name": delta.function.name or "", "arguments": ""},
+            )
+            self.argument_chunks[index] = []
+            self._depth[index] = 0
+            self._in_string[index] = False
+            self._escaped[index] = False
+        elif delta.function.name:
+            self.calls[index].function.name += delta.function.name
+        if index in self.tasks or not delta.function.arguments:
+            return
+        self.argument_chunks[index].append(delta.function.arguments)
+        if self._closes_object(index, delta.function.arguments):
+            self._dispatch(index)
+
+    def _closes_object(self, index: int, chunk: str) -> bool:
+        depth = self._depth[index]
+        in_string = self._in_string[index]
+        escaped = self._escaped[index]
+        closed = False
+        for char in chunk:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+                closed = depth == 0
+        self._depth[index] = depth
+        self._in_string[index] = in_string
+        self._escaped[index] = escaped
+        return closed
+
+    def _dispatch(self, index: int) -> None:
+        arguments = "".join(self.argument_chunks[index])
+        try:
+            json.loads(arguments)
+        except ValueError:
+            # Not a complete JSON object yet, wait for more chunks or the end of the stream.
+            return
+        tool_call = self.calls[index]
+        tool_call.function.arguments = arguments
+        self.tasks[index] = asyncio.ensure_future(get_tool_call_result(tool_call))
+
+    async def results(self) -> list[fp.ToolResultDefinition]:
+        """Waits for all calls, starting the ones that were not complete yet, in order."""
+        for index in self.calls:
+            if index not in self.tasks:
+                arguments = "".join(self.argument_chunks[index])
+                self.calls[index].function.arguments = arguments
+                self.tasks[index] = asyncio.ensure_future(
+                    get_tool_call_result(self.calls[index])
+                )
+        return list(await asyncio.gather(*(self.tasks[i] for i in self.calls)))
+
+    def cancel(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+
+
 class FunctionCallingLoopBot(fp.PoeBot):
     async def get_response(
         self, request: fp.QueryRequest
     ) -> AsyncIterable[fp.PartialResponse]:
         # Load the tool messages from the previous calls to this server bot
-        chat_context_with_metadata_expanded: list[fp.ProtocolMessage] = []
-        for msg in request.query:
-            if msg.metadata is not None:
-                metadata_message_dicts = json.loads(msg.metadata)
-                chat_context_with_metadata_expanded.extend(
-                    [
-                        fp.ProtocolMessage.model_validate(metadata_message_dict)
-                        for metadata_message_dict in metadata_message_dicts
-                    ]
-                )
-            chat_context_with_metadata_expanded.append(
-                msg.model_copy(update={"metadata": None})
-            )
-        request.query = chat_context_with_metadata_expanded
+        request.query = tool_history_cache.expand_query(request)
         tool_messages: list[fp.ProtocolMessage] = []
 
         continue_tool_loop = True
         call_count = 0
         while continue_tool_loop:
             continue_tool_loop = False
-            tool_calls: dict[int, fp.ToolCallDefinition] = {}
+            assembler = ToolCallAssembler()
             call_count += 1
 
             # Make sure to produce a final response if no more bot calls are allowed.
@@ -95,33 +207,36 @@ class FunctionCallingLoopBot(fp.PoeBot):
 
             # 1. [First iteration] Make a request to the model with tools it could call
             # 4. [Subsequent iterations] Make another request to the model with the tool output
-            async for msg in fp.stream_request(
-                request,
-                TOOL_CALL_BOT,
-                request.access_key,
-                tools=None if force_final_response else tool_definitions,
-            ):
-                # 2. [First iteration] Receive a tool call from the model
-                # 5. [Subsequent iterations] Receive a final response from the model (or more
-                # tool calls)
-                if msg.tool_calls:
-                    for tool_call in msg.tool_calls:
-                        if tool_call.index not in tool_calls:
-                            tool_calls[tool_call.index] = tool_call
-                        else:
-                            tool_calls[
-                                tool_call.index
-                            ].function.arguments += tool_call.function.arguments
-                    continue_tool_loop = True
-
-                else:
-                    yield msg
-
-            tool_results: list[fp.ToolResultDefinition] = []
-            for tool_call in tool_calls.values():
-                # 3. Execute code on the application side with input from the tool call
-                tool_result = get_tool_call_result(tool_call)
-                tool_results.append(tool_result)
+            compacted_query = compact_tool_context(
+                request.query, CONTEXT_TOKEN_BUDGET, KEEP_RECENT_TOOL_EXCHANGES
+            )
+            try:
+                async for msg in fp.stream_request(
+                    request.model_copy(update={"query": compacted_query}),
+                    TOOL_CALL_BOT,
+                    request.access_key,
+                    tools=None if force_final_response else tool_definitions,
+                ):
+                    # 2. [First iteration] Receive a tool call from the model
+                    # 5. [Subsequent iterations] Receive a final response from the model
+                    # (or more tool calls)
+                    if msg.tool_calls:
+                        # 3. Execute code on the application side with input from the tool
+                        # calls. Each call starts as soon as its arguments are complete,
+                        # while the model is still streaming the other ones.
+                        for tool_call in msg.tool_calls:
+                            assembler.add(tool_call)
+                        continue_tool_loop = True
+
+                    else:
+                        yield msg
+
+                # The results keep the order of the tool calls.
+                tool_results = await assembler.results()
+            except BaseException:
+                assembler.cancel()
+                raise
+            tool_calls = assembler.calls
 
             # Add the tool calls and results to the context for subsequent requests to the model
             if tool_calls and tool_results:
@@ -145,11 +260,7 @@ class FunctionCallingLoopBot(fp.PoeBot):
                 tool_messages.append(tool_result_message)
 
         # Store the tool messages for later calls to this server bot
-        yield fp.DataResponse(
-            metadata=json.dumps(
-                [tool_message.model_dump() for tool_message in tool_messages]
-            )
-        )
+        yield fp.DataResponse(metadata=encode_tool_messages(tool_messages))
 
     async def get_settings(self, setting: fp.SettingsRequest) -> fp.SettingsResponse:
         return fp.SettingsResponse(
@@ -157,7 +268,7 @@ class FunctionCallingLoopBot(fp.PoeBot):
         )
 
 
-REQUIREMENTS = ["fastapi-poe==0.0.68", "requests"]
+REQUIREMENTS = ["fastapi-poe==0.0.68", "httpx"]
 image = (
     Image.debian_slim()
     .pip_install(*REQUIREMENTS)
@@ -176,4 +287,9 @@ def fastapi_app():
         bot_name=bot_name,
         allow_without_key=not (bot_access_key and bot_name),
     )
+
+    @app.get("/tool_cache_stats")
+    async def tool_cache_stats() -> dict:
+        return get_tool_cache_stats()
+
     return app
@@ -8,19 +8,101 @@ Example PoeBot that:
 
 from __future__ import annotations
 
+import asyncio
 import os
-from typing import AsyncIterable
+import re
+from collections import OrderedDict
+from typing import AsyncIterable, Optional
 
 import fastapi_poe as fp
 from modal import App, Image, asgi_app
 
+from stream_utils import StreamCollector
+
 # TODO: set your bot access key and bot name for full functionality
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
 bot_name = ""
 
+# Start generating the image as soon as Claude has named the recommended top, while it is
+# still writing the rest of its recommendation.
+START_IMAGE_EARLY = True
+# Claude is asked to start with this line. The phrase is stable once its line has ended.
+RECOMMENDED_TOP_PATTERN = re.compile(
+    r"^\W*recommended top\W*:[\s*_]*(?P<top>[^\n]+?)[\s*_]*\n",
+    re.IGNORECASE | re.MULTILINE,
+)
+# Markdown emphasis, which Imagen would otherwise take as part of the description.
+EMPHASIS_PATTERN = re.compile(r"\*+|(?<!\w)_+|_+(?!\w)")
+# The prompt for Imagen already has an article before the description.
+LEADING_ARTICLE_PATTERN = re.compile(r"^(?:an?|the)\s+", re.IGNORECASE)
+
+
+MAX_CACHED_MESSAGES = 4096
+
+# The latest user image as of each message, by message id. The history before a message
+# never changes, so a lookup can stop at the first message it already looked up.
+_user_image_cache: OrderedDict[str, Optional[fp.Attachment]] = OrderedDict()
+
+
+def find_recommended_top(text: str) -> Optional[str]:
+    match = RECOMMENDED_TOP_PATTERN.search(text)
+    if match is None:
+        return None
+    top = " ".join(EMPHASIS_PATTERN.sub("", match.group("top")).split())
+    return LEADING_ARTICLE_PATTERN.sub("", top) or None
+
+
+def find_user_image(query: list[fp.ProtocolMessage]) -> Optional[fp.Attachment]:
+    """Returns the first image attached to the latest user message that has one."""
+    user_image = None
+    for message in reversed(query):
+        if message.message_id in _user_image_cache:
+            user_image = _user_image_cache[message.message_id]
+            _user_image_cache.move_to_end(message.message_id)
+            break
+        if message.role == "user" and message.attachments:
+            # Just pick the first image we find
+            for attachment in message.attachments:
+                if attachment.content_type.startswith("image/"):
+                    user_image = attachment
+                    break
+        if user_image:
+            break
+
+    if query and query[-1].message_id:
+        _user_image_cache[query[-1].message_id] = user_image
+        _user_image_cache.move_to_end(query[-1].message_id)
+        while len(_user_image_cache) > MAX_CACHED_MESSAGES:
+            _user_image_cache.popitem(last=False)
+    return user_image
+
 
 class OutfitRecommenderBot(fp.PoeBot):
+    async def generate_top_image(
+        self, request: fp.QueryRequest, recommended_top: str
+    ) -> Optional[fp.Attachment]:
+        # Imagen3-Fast only needs the description of the top, not the conversation.
+        imagen_request = request.model_copy(
+            update={
+                "query": [
+                    fp.ProtocolMessage(
+                        role="user",
+                        content=f"Please create an image of a {recommended_top} only. "
+                        "White background.",
+                    )
+                ]
+            }
+        )
+        generated_image = None
+        async for msg in fp.stream_request(
+            imagen_request, "Imagen3-Fast", request.access_key
+        ):
+            if msg.attachment:
+                # If Imagen3-Fast responds with an attachment, pick it out
+                generated_image = msg.attachment
+        return generated_image
+
     async def get_response(
         self, request: fp.QueryRequest
     ) -> AsyncIterable[fp.PartialResponse]:
@@ -28,20 +110,13 @@ class OutfitRecommenderBot(fp.PoeBot):
         1) Find the *latest* user image if present.
         2) Call Claude-3.5-Sonnet: "Analyze the person's outfit & recommend a new top."
         3) Take Claude's recommended top text & call Imagen3-Fast to generate an image of that top.
-        5) Return the generated image of recommended top to user.
+           With START_IMAGE_EARLY, this starts as soon as Claude has named the top.
+        5) Return the generated image of recommended top to user. Imagen's URL is shown
+           right away, and replaced by a re-hosted attachment once it is uploaded.
         """
 
         # 1) Identify user's image (if any)
-        user_image = None
-        for message in reversed(request.query):
-            if message.role == "user" and message.attachments:
-                # Just pick the first image we find
-                for attachment in message.attachments:
-                    if attachment.content_type.startswith("image/"):
-                        user_image = attachment
-                        break
-            if user_image:
-                break
+        user_image = find_user_image(request.query)
 
         if not user_image:
             # If there's no image, we let the user know that we need one
@@ -57,6 +132,8 @@ class OutfitRecommenderBot(fp.PoeBot):
             "Please analyze the person's outfit accordingly:\n"
             "1) They want to change the top they are wearing (e.g., a shirt or jacket).\n"
             "2) Suggest a single new top style, with some details, e.g. color or design.\n"
+            "Start your response with a single line of the form "
+            "'Recommended top: <short description of the top>'.\n"
             "Keep your response concise and to the point."
             "NOTE: The user's attached image is their current outfit."
         )
@@ -68,37 +145,51 @@ class OutfitRecommenderBot(fp.PoeBot):
             update={"query": [last_message_with_claude_query]}
         )
 
-        recommended_top = None
-        recommended_top_text = ""
-        async for msg in fp.stream_request(
-            claude_request, "Claude-3.5-Sonnet", request.access_key
-        ):
-            if msg.text:
-                recommended_top_text += msg.text
-            yield fp.PartialResponse(text=msg.text)
+        image_task: Optional[asyncio.Future[Optional[fp.Attachment]]] = None
+        # Only the new text and the unfinished line before it are searched for the
+        # recommended top, so the response isn't searched again for every chunk.
+        unsearched_text = ""
+        try:
+            collector = StreamCollector()
+            async for msg in collector.forward(
+                fp.stream_request(
+                    claude_request, "Claude-3.5-Sonnet", request.access_key
+                )
+            ):
+                yield fp.PartialResponse(text=msg.text)
+                if not START_IMAGE_EARLY or image_task is not None:
+                    continue
+                unsearched_text += msg.text
+                if "\n" in msg.text:
+                    early_top = find_recommended_top(unsearched_text)
+                    if early_top:
+                        image_task = asyncio.ensure_future(
+                            self.generate_top_image(request, early_top)
+                        )
+                    unsearched_text = unsearched_text.rsplit("\n", 1)[1]
 
-        recommended_top = recommended_top_text.strip()
-        if not recommended_top:
-            yield fp.ErrorResponse(
-                text="I was unable to get a clothing recommendation from Claude."
-            )
-            return
+            recommended_top = collector.text.strip()
+            if not recommended_top:
+                yield fp.ErrorResponse(
+                    text="I was unable to get a clothing recommendation from Claude."
+                )
+                return
 
-        # 3) Ask Imagen3-Fast to generate an image of the recommended top
-        imagen_request = request.model_copy(deep=True)
-        imagen_request.query[-1].content = (
-            f"Please create an image of a {recommended_top} only. White background."
-        )
+            # 3) Ask Imagen3-Fast to generate an image of the recommended top, unless it
+            # was already started while Claude was responding
+            if image_task is None:
+                image_task = asyncio.ensure_future(
+                    self.generate_top_image(
+                        request,
+                        find_recommended_top(recommended_top + "\n") or recommended_top,
+                    )
+                )
 
-        yield fp.PartialResponse(text="\n\nGenerating an example image...")
-
-        generated_image = None
-        async for msg in fp.stream_request(
-            imagen_request, "Imagen3-Fast", request.access_key
-        ):
-            if msg.attachment:
-                # If Imagen3-Fast responds with an attachment, pick it out
-                generated_image = msg.attachment
+            yield fp.PartialResponse(text="\n\nGenerating an example image...")
+            generated_image = await image_task
+        finally:
+            if image_task is not None:
+                image_task.cancel()
 
         if not generated_image:
             yield fp.ErrorResponse(
@@ -106,18 +197,30 @@ class OutfitRecommenderBot(fp.PoeBot):
             )
             return
 
-        # Now attach the final image
-        attachment_response = await self.post_message_attachment(
-            message_id=request.message_id,
-            download_url=generated_image.url,
-            is_inline=True,
+        # Show Imagen's image right away, while it is re-hosted as an attachment of this
+        # message in the background. Both versions share their text up to the image, so
+        # only the image changes when it is swapped.
+        image_intro = "\n\nHere's an image of the recommended top:\n\n"
+        response_text = (
+            f"{collector.text}\n\nGenerating an example image...{image_intro}"
         )
-        yield fp.PartialResponse(
-            text=(
-                "\n\nHere's an image of the recommended top![new_top]["
-                f"{attachment_response.inline_ref}]"
+        upload_task = asyncio.ensure_future(
+            self.post_message_attachment(
+                message_id=request.message_id,
+                download_url=generated_image.url,
+                is_inline=True,
             )
         )
+        yield fp.PartialResponse(text=f"{image_intro}![new_top]({generated_image.url})")
+        try:
+            attachment_response = await upload_task
+        except Exception:
+            # Imagen's URL is still shown, so the response is usable without the upload.
+            return
+        yield fp.PartialResponse(
+            text=f"{response_text}![new_top][{attachment_response.inline_ref}]",
+            is_replace_response=True,
+        )
 
     async def get_settings(self, setting: fp.SettingsRequest) -> fp.SettingsResponse:
         """
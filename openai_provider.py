@@ -0,0 +1,209 @@
+"""
+
+Provider layer for bots that stream chat completions from an OpenAI-compatible API.
+
+`OpenAIProvider` keeps one pooled client per container, and gives every request a
+deadline. Failures before the first token are retried with jittered exponential backoff,
+and a request that has not produced its first token after HEDGE_DELAY seconds is hedged
+with a second identical request, keeping whichever starts first. Once a token has been
+streamed to the user, a failure is never retried, since the user has already seen part
+of a response.
+
+Set OPENAI_BASE_URL to point the provider at any OpenAI-compatible endpoint, such as a
+local server for load testing.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+from typing import Any, AsyncIterator, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+CONNECT_TIMEOUT = 5.0
+# Time allowed for the whole response, including retries and hedged requests.
+REQUEST_DEADLINE = 60.0
+# Time allowed for each attempt to produce its first token.
+FIRST_TOKEN_TIMEOUT = 15.0
+MAX_RETRIES = 2
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 4.0
+# Set to None to disable hedged requests.
+HEDGE_DELAY: Optional[float] = 3.0
+
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a response doesn't start or finish within its deadline."""
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter, so retries of many requests spread out."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+class _Attempt:
+    """A single streaming request, read up to and including its first content chunk."""
+
+    def __init__(self, stream: Any) -> None:
+        self.stream = stream
+        self.chunks = stream.__aiter__()
+        self.first_text: Optional[str] = None
+
+    async def read_first_token(self) -> _Attempt:
+        async for chunk in self.chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                self.first_text = chunk.choices[0].delta.content
+                break
+        return self
+
+    async def close(self) -> None:
+        await self.chunks.aclose()
+        await self.stream.close()
+
+
+class OpenAIProvider:
+    def __init__(
+        self,
+        *,
+        base_url: Optional[str] = OPENAI_BASE_URL,
+        api_key: Optional[str] = None,
+        max_connections: int = MAX_CONNECTIONS,
+        max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+        request_deadline: float = REQUEST_DEADLINE,
+        first_token_timeout: float = FIRST_TOKEN_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+        hedge_delay: Optional[float] = HEDGE_DELAY,
+    ) -> None:
+        self.request_deadline = request_deadline
+        self.first_token_timeout = first_token_timeout
+        self.max_retries = max_retries
+        self.hedge_delay = hedge_delay
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+            timeout=httpx.Timeout(request_deadline, connect=CONNECT_TIMEOUT),
+        )
+        api_key = api_key or os.getenv("OPENAI_API_KEY")
+        if not api_key and base_url:
+            # Local OpenAI-compatible servers usually don't check the key.
+            api_key = "unused"
+        # Retries are handled here, where it is known whether a token was streamed.
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            http_client=self.http_client,
+        )
+        self.stats = {"requests": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    async def _start_attempt(self, params: dict[str, Any]) -> _Attempt:
+        stream = await self.client.chat.completions.create(stream=True, **params)
+        attempt = _Attempt(stream)
+        try:
+            return await attempt.read_first_token()
+        except BaseException:
+            await attempt.close()
+            raise
+
+    async def _race(
+        self, params: dict[str, Any], tasks: list[asyncio.Future[_Attempt]]
+    ) -> _Attempt:
+        tasks.append(asyncio.ensure_future(self._start_attempt(params)))
+        pending = set(tasks)
+        while True:
+            hedge_timeout = self.hedge_delay if len(tasks) == 1 else None
+            done, pending = await asyncio.wait(
+                pending, timeout=hedge_timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                # No first token yet, so hedge with a second identical request.
+                self.stats["hedges"] += 1
+                tasks.append(asyncio.ensure_future(self._start_attempt(params)))
+                pending.add(tasks[-1])
+                continue
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        self.stats["hedge_wins"] += 1
+                    return task.result()
+            if not pending:
+                # Every request failed, so raise the error of one of them.
+                return done.pop().result()
+
+    async def _first_token(self, params: dict[str, Any], timeout: float) -> _Attempt:
+        """Starts a request, hedging it if it is slow, and returns the first to start."""
+        tasks: list[asyncio.Future[_Attempt]] = []
+        winner = None
+        try:
+            winner = await asyncio.wait_for(self._race(params, tasks), timeout)
+            return winner
+        finally:
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, _Attempt) and result is not winner:
+                    await result.close()
+
+    async def stream_chat_completion(self, **params: Any) -> AsyncIterator[str]:
+        """Streams the text of a chat completion, with retries before the first token."""
+        self.stats["requests"] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.request_deadline
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            try:
+                current = await self._first_token(
+                    params, min(self.first_token_timeout, remaining)
+                )
+                break
+            except RETRYABLE_ERRORS as e:
+                delay = retry_delay(attempt)
+                if attempt >= self.max_retries or loop.time() + delay >= deadline:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise DeadlineExceededError from e
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+
+        try:
+            if current.first_text is None:
+                return
+            yield current.first_text
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise DeadlineExceededError
+                try:
+                    chunk = await asyncio.wait_for(
+                        current.chunks.__anext__(), remaining
+                    )
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    raise DeadlineExceededError from None
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await current.close()
+
+    async def aclose(self) -> None:
+        await self.client.close()
@@ -1,31 +1,113 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
-from typing import AsyncIterable
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import IO, AsyncIterable, Optional
 
 import fastapi_poe as fp
-import requests
+import httpx
 from modal import App, Image, asgi_app
-from PyPDF2 import PdfReader
+
+from pdf_page_count import read_page_count_and_title
 
 # TODO: set your bot access key and bot name for full functionality
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
 bot_name = ""
 
+# Maximum number of pdfs downloaded and parsed at the same time for one request.
+MAX_CONCURRENT_DOWNLOADS = 4
+DOWNLOAD_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+# Pdf info is cached across conversation turns so only newly attached pdfs are fetched.
+MAX_CACHED_PDFS = 1024
+PDF_CACHE_TTL = 60 * 60
+
 
 class FileDownloadError(Exception):
     pass
 
 
-def _fetch_pdf_and_count_num_pages(url: str) -> int:
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise FileDownloadError()
-    with open("temp_pdf_file.pdf", "wb") as f:
-        f.write(response.content)
-    reader = PdfReader("temp_pdf_file.pdf")
-    return len(reader.pages)
+@dataclass
+class PdfInfo:
+    num_pages: int
+    size: int
+    sha256: str
+    title: Optional[str] = None
+
+
+class PdfInfoCache:
+    """Bounded cache of pdf info whose entries expire after `ttl` seconds.
+
+    Entries are stored both by attachment url and by content hash, so the same file
+    uploaded again under a new url still only needs to be downloaded, not parsed.
+
+    """
+
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, PdfInfo]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[PdfInfo]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, info = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return info
+
+    def put(self, key: str, info: PdfInfo) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, info)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+_pdf_info_cache = PdfInfoCache(MAX_CACHED_PDFS, PDF_CACHE_TTL)
+
+
+def _read_pdf_info(file: IO[bytes], size: int, sha256: str) -> PdfInfo:
+    num_pages, title = read_page_count_and_title(file)
+    return PdfInfo(num_pages=num_pages, size=size, sha256=sha256, title=title)
+
+
+async def _fetch_pdf_info(client: httpx.AsyncClient, url: str) -> PdfInfo:
+    info = _pdf_info_cache.get(f"url:{url}")
+    if info is not None:
+        return info
+
+    # Download to a temporary file so it can be memory-mapped.
+    with tempfile.TemporaryFile() as file:
+        content_hash = hashlib.sha256()
+        try:
+            async with client.stream("GET", url) as response:
+                if response.status_code != 200:
+                    raise FileDownloadError()
+                async for chunk in response.aiter_bytes():
+                    file.write(chunk)
+                    content_hash.update(chunk)
+        except httpx.HTTPError as e:
+            raise FileDownloadError() from e
+        sha256 = content_hash.hexdigest()
+
+        info = _pdf_info_cache.get(f"sha256:{sha256}")
+        if info is None:
+            size = file.tell()
+            file.seek(0)
+            # Parsing is blocking, so run it in a thread to keep the event loop responsive.
+            loop = asyncio.get_running_loop()
+            info = await loop.run_in_executor(None, _read_pdf_info, file, size, sha256)
+            _pdf_info_cache.put(f"sha256:{sha256}", info)
+    _pdf_info_cache.put(f"url:{url}", info)
+    return info
 
 
 class PDFSizeBot(fp.PoeBot):
@@ -35,24 +117,46 @@ class PDFSizeBot(fp.PoeBot):
         yield fp.PartialResponse(
             text="Iterating over the pdfs uploaded in this conversation ..."
         )
-        for message in reversed(request.query):
-            for attachment in message.attachments:
-                if attachment.content_type == "application/pdf":
+        attachments = [
+            attachment
+            for message in reversed(request.query)
+            for attachment in message.attachments
+            if attachment.content_type == "application/pdf"
+        ]
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+        async with httpx.AsyncClient(
+            follow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+        ) as client:
+
+            async def _count_pages(attachment: fp.Attachment) -> fp.PartialResponse:
+                async with semaphore:
                     try:
-                        num_pages = _fetch_pdf_and_count_num_pages(attachment.url)
-                        yield fp.PartialResponse(
-                            text=f"{attachment.name} has {num_pages} pages.\n"
-                        )
+                        info = await _fetch_pdf_info(client, attachment.url)
                     except FileDownloadError:
-                        yield fp.PartialResponse(
+                        return fp.PartialResponse(
                             text="Failed to retrieve the document."
                         )
+                return fp.PartialResponse(
+                    text=f"{attachment.name} has {info.num_pages} pages.\n"
+                )
+
+            tasks = [
+                asyncio.ensure_future(_count_pages(attachment))
+                for attachment in attachments
+            ]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield await task
+            finally:
+                for task in tasks:
+                    task.cancel()
 
     async def get_settings(self, setting: fp.SettingsRequest) -> fp.SettingsResponse:
         return fp.SettingsResponse(allow_attachments=True)
 
 
-REQUIREMENTS = ["fastapi-poe", "PyPDF2==3.0.1", "requests==2.31.0"]
+REQUIREMENTS = ["fastapi-poe", "PyPDF2==3.0.1", "httpx"]
 image = (
     Image.debian_slim()
     .pip_install(*REQUIREMENTS)
@@ -0,0 +1,467 @@
+"""
+
+Fast page counting for pdfs.
+
+Instead of parsing the whole document, the file is memory-mapped and only the trailer,
+the cross-reference (xref) data and the root of the page tree are read to get the page
+tree's /Count. The title is read the same way, from the document information dictionary
+that the trailer points to. This keeps memory flat regardless of the size of the file. If
+that structure is damaged or uses features not handled here, we fall back to PyPDF2.
+
+"""
+
+from __future__ import annotations
+
+import mmap
+import re
+import zlib
+from typing import IO, Optional, Union
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import decode_pdfdocencoding
+
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+_OBJ_HEADER_RE = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj")
+_XREF_SUBSECTION_RE = re.compile(rb"\s*(\d+)\s+(\d+)[ \t]*(?:\r\n|\r|\n)")
+_XREF_ENTRY_RE = re.compile(rb"(\d{10}) (\d{5}) ([nf])")
+_ROOT_RE = re.compile(rb"/Root\s+(\d+)\s+\d+\s+R")
+_PAGES_RE = re.compile(rb"/Pages\s+(\d+)\s+\d+\s+R")
+_INFO_RE = re.compile(rb"/Info\s+(\d+)\s+\d+\s+R")
+_ENCRYPT_RE = re.compile(rb"/Encrypt\b")
+_TITLE_RE = re.compile(rb"/Title\s*")
+_REFERENCE_RE = re.compile(rb"(\d+)\s+\d+\s+R")
+_PREV_RE = re.compile(rb"/Prev\s+(\d+)")
+_XREF_STM_RE = re.compile(rb"/XRefStm\s+(\d+)")
+_COUNT_RE = re.compile(rb"/Count\s+(\d+)\b(\s+\d+\s+R\b)?")
+_PAGES_TYPE_RE = re.compile(rb"/Type\s*/Pages\b")
+_W_RE = re.compile(rb"/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]")
+_INDEX_RE = re.compile(rb"/Index\s*\[([\d\s]*)\]")
+_SIZE_RE = re.compile(rb"/Size\s+(\d+)")
+_FILTER_RE = re.compile(rb"/Filter\s*\[?\s*/(\w+)")
+_PREDICTOR_RE = re.compile(rb"/Predictor\s+(\d+)")
+_COLUMNS_RE = re.compile(rb"/Columns\s+(\d+)")
+_N_RE = re.compile(rb"/N\s+(\d+)")
+_FIRST_RE = re.compile(rb"/First\s+(\d+)")
+
+# startxref is required to be at the very end of the file.
+_TRAILER_SEARCH_SIZE = 1024
+_LITERAL_ESCAPES = {
+    ord("n"): b"\n",
+    ord("r"): b"\r",
+    ord("t"): b"\t",
+    ord("b"): b"\b",
+    ord("f"): b"\f",
+}
+# Every entry of a classic xref table is exactly 20 bytes long.
+_XREF_ENTRY_SIZE = 20
+
+
+class MalformedPdfError(Exception):
+    pass
+
+
+def _search(pattern: re.Pattern[bytes], data: bytes) -> int:
+    match = pattern.search(data)
+    if match is None:
+        raise MalformedPdfError(f"{pattern.pattern!r} not found")
+    return int(match.group(1))
+
+
+class _XrefReader:
+    """Looks up objects in a memory-mapped pdf through its xref sections."""
+
+    def __init__(self, mm: mmap.mmap) -> None:
+        self.mm = mm
+        tail_start = max(0, len(mm) - _TRAILER_SEARCH_SIZE)
+        matches = list(_STARTXREF_RE.finditer(mm, tail_start))
+        if not matches:
+            raise MalformedPdfError("startxref not found")
+        self.startxref = int(matches[-1].group(1))
+        self.root: int | None = None
+        self.info: int | None = None
+        self.encrypted = False
+        # Decoded xref streams by offset, as `(widths, index, data)`.
+        self._xref_streams: dict[int, tuple[list[int], list[int], bytes]] = {}
+
+    def _check_offset(self, offset: int) -> int:
+        if not 0 <= offset < len(self.mm):
+            raise MalformedPdfError(f"offset {offset} out of range")
+        return offset
+
+    def _object_bounds(
+        self, offset: int, obj_num: int | None = None
+    ) -> tuple[int, int]:
+        """Returns the start and end of the body of the object at `offset`."""
+        match = _OBJ_HEADER_RE.match(self.mm, self._check_offset(offset))
+        if match is None or (obj_num is not None and int(match.group(1)) != obj_num):
+            raise MalformedPdfError(f"no matching object at offset {offset}")
+        end = self.mm.find(b"endobj", match.end())
+        if end == -1:
+            raise MalformedPdfError(f"unterminated object at offset {offset}")
+        return match.end(), end
+
+    def _read_stream(self, offset: int) -> tuple[bytes, bytes]:
+        """Returns the dictionary and the decoded data of the stream object at `offset`."""
+        start, end = self._object_bounds(offset)
+        stream_keyword = self.mm.find(b"stream", start, end)
+        if stream_keyword == -1:
+            raise MalformedPdfError(f"object at offset {offset} is not a stream")
+        stream_dict = self.mm[start:stream_keyword]
+        data_start = stream_keyword + len(b"stream")
+        # The stream keyword is followed by either CRLF or LF.
+        data_start += (
+            2 if self.mm.find(b"\r\n", data_start, data_start + 2) != -1 else 1
+        )
+        data_end = self.mm.rfind(b"endstream", data_start, end)
+        if data_end == -1:
+            raise MalformedPdfError(f"unterminated stream at offset {offset}")
+
+        filter_match = _FILTER_RE.search(stream_dict)
+        if filter_match is None:
+            data = self.mm[data_start:data_end]
+        elif filter_match.group(1) == b"FlateDecode":
+            data = zlib.decompressobj().decompress(self.mm[data_start:data_end])
+        else:
+            raise MalformedPdfError(f"unsupported filter {filter_match.group(1)!r}")
+
+        predictor_match = _PREDICTOR_RE.search(stream_dict)
+        if predictor_match is not None and int(predictor_match.group(1)) >= 10:
+            columns_match = _COLUMNS_RE.search(stream_dict)
+            columns = int(columns_match.group(1)) if columns_match else 1
+            data = _undo_png_predictor(data, columns)
+        return stream_dict, data
+
+    def _locate_in_xref_stream(
+        self, offset: int, obj_num: int
+    ) -> tuple[int, int, int] | None:
+        if offset not in self._xref_streams:
+            stream_dict, data = self._read_stream(offset)
+            w_match = _W_RE.search(stream_dict)
+            if w_match is None:
+                raise MalformedPdfError("xref stream without /W")
+            index_match = _INDEX_RE.search(stream_dict)
+            if index_match is not None:
+                index = [int(value) for value in index_match.group(1).split()]
+            else:
+                index = [0, _search(_SIZE_RE, stream_dict)]
+            widths = [int(width) for width in w_match.groups()]
+            self._xref_streams[offset] = (widths, index, data)
+        widths, index, data = self._xref_streams[offset]
+        row_size = sum(widths)
+
+        row = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            if first <= obj_num < first + count:
+                row += obj_num - first
+                break
+            row += count
+        else:
+            return None
+
+        position = row * row_size
+        if position + row_size > len(data):
+            raise MalformedPdfError("truncated xref stream")
+        fields = []
+        for width in widths:
+            field_end = position + width
+            fields.append(int.from_bytes(data[position:field_end], "big"))
+            position = field_end
+        # A zero width type field defaults to type 1 (uncompressed object).
+        entry_type = fields[0] if widths[0] else 1
+        return entry_type, fields[1], fields[2]
+
+    def _locate_in_xref_table(
+        self, offset: int, obj_num: int
+    ) -> tuple[int, int, int] | None:
+        position = offset + len(b"xref")
+        while True:
+            match = _XREF_SUBSECTION_RE.match(self.mm, position)
+            if match is None:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            if first <= obj_num < first + count:
+                entry_start = match.end() + (obj_num - first) * _XREF_ENTRY_SIZE
+                entry = _XREF_ENTRY_RE.match(self.mm, entry_start)
+                if entry is None:
+                    raise MalformedPdfError("invalid xref table entry")
+                if entry.group(3) == b"f":
+                    return 0, 0, 0
+                return 1, int(entry.group(1)), int(entry.group(2))
+            position = match.end() + count * _XREF_ENTRY_SIZE
+        return None
+
+    def _trailer(self, offset: int) -> bytes:
+        """Returns the trailer dictionary of the classic xref table at `offset`."""
+        trailer_start = self.mm.find(b"trailer", offset)
+        if trailer_start == -1:
+            raise MalformedPdfError("trailer not found")
+        trailer_end = self.mm.find(b"startxref", trailer_start)
+        if trailer_end == -1:
+            trailer_end = min(len(self.mm), trailer_start + _TRAILER_SEARCH_SIZE)
+        return self.mm[trailer_start:trailer_end]
+
+    def sections(self) -> list[tuple[int, bool]]:
+        """Returns `(offset, is_table)` for every xref section, newest first."""
+        sections = []
+        offset: int | None = self.startxref
+        seen = set()
+        while offset is not None:
+            if offset in seen:
+                raise MalformedPdfError("cycle in xref sections")
+            seen.add(offset)
+            self._check_offset(offset)
+            if self.mm.find(b"xref", offset, offset + len(b"xref")) == offset:
+                trailer = self._trailer(offset)
+                sections.append((offset, True))
+                # Hybrid files keep some of their objects in an additional xref stream.
+                xref_stm_match = _XREF_STM_RE.search(trailer)
+                if xref_stm_match is not None:
+                    sections.append((int(xref_stm_match.group(1)), False))
+            else:
+                start, end = self._object_bounds(offset)
+                stream_keyword = self.mm.find(b"stream", start, end)
+                if stream_keyword == -1:
+                    raise MalformedPdfError(f"no xref at offset {offset}")
+                trailer = self.mm[start:stream_keyword]
+                sections.append((offset, False))
+            if self.root is None:
+                root_match = _ROOT_RE.search(trailer)
+                if root_match is not None:
+                    self.root = int(root_match.group(1))
+            if self.info is None:
+                info_match = _INFO_RE.search(trailer)
+                if info_match is not None:
+                    self.info = int(info_match.group(1))
+            if _ENCRYPT_RE.search(trailer) is not None:
+                self.encrypted = True
+            prev_match = _PREV_RE.search(trailer)
+            offset = int(prev_match.group(1)) if prev_match else None
+        if self.root is None:
+            raise MalformedPdfError("/Root not found")
+        return sections
+
+    def _locate(
+        self, sections: list[tuple[int, bool]], obj_num: int
+    ) -> tuple[int, int, int]:
+        """Returns the xref entry of the given object as `(type, field 2, field 3)`."""
+        for offset, is_table in sections:
+            if is_table:
+                location = self._locate_in_xref_table(offset, obj_num)
+            else:
+                location = self._locate_in_xref_stream(offset, obj_num)
+            if location is not None:
+                return location
+        raise MalformedPdfError(f"object {obj_num} not found")
+
+    def read_object(self, sections: list[tuple[int, bool]], obj_num: int) -> bytes:
+        """Returns the body of the given object."""
+        entry_type, field_2, field_3 = self._locate(sections, obj_num)
+        if entry_type == 1:
+            start, end = self._object_bounds(field_2, obj_num)
+            return self.mm[start:end]
+        elif entry_type == 2:
+            return self._read_compressed_object(sections, field_2, field_3)
+        raise MalformedPdfError(f"object {obj_num} is free")
+
+    def _read_compressed_object(
+        self, sections: list[tuple[int, bool]], stream_num: int, index: int
+    ) -> bytes:
+        entry_type, offset, _ = self._locate(sections, stream_num)
+        if entry_type != 1:
+            raise MalformedPdfError(
+                f"object stream {stream_num} is not stored directly"
+            )
+
+        stream_dict, data = self._read_stream(offset)
+        num_objects = _search(_N_RE, stream_dict)
+        first = _search(_FIRST_RE, stream_dict)
+        if not 0 <= index < num_objects:
+            raise MalformedPdfError("object stream index out of range")
+        header = [int(value) for value in data[:first].split()]
+        offsets = [first + offset for offset in header[1::2]] + [len(data)]
+        object_start, object_end = offsets[index], offsets[index + 1]
+        return data[object_start:object_end]
+
+
+def _undo_png_predictor(data: bytes, columns: int) -> bytes:
+    """Decodes rows encoded with the PNG None, Sub or Up predictors."""
+    row_size = columns + 1
+    if len(data) % row_size:
+        raise MalformedPdfError("invalid predictor row size")
+    output = bytearray()
+    previous_row = bytearray(columns)
+    for row_start in range(0, len(data), row_size):
+        filter_type = data[row_start]
+        row_data_start, row_end = row_start + 1, row_start + row_size
+        row = bytearray(data[row_data_start:row_end])
+        if filter_type == 1:
+            for i in range(1, columns):
+                row[i] = (row[i] + row[i - 1]) & 0xFF
+        elif filter_type == 2:
+            for i in range(columns):
+                row[i] = (row[i] + previous_row[i]) & 0xFF
+        elif filter_type != 0:
+            raise MalformedPdfError(f"unsupported png predictor {filter_type}")
+        output += row
+        previous_row = row
+    return bytes(output)
+
+
+def _parse_literal_string(data: bytes, position: int) -> bytes:
+    """Parses the literal string that starts with the "(" at `position`."""
+    output = bytearray()
+    depth = 0
+    while position < len(data):
+        char = data[position]
+        position += 1
+        if char == ord("\\"):
+            if position >= len(data):
+                break
+            escaped = data[position]
+            position += 1
+            if escaped in _LITERAL_ESCAPES:
+                output += _LITERAL_ESCAPES[escaped]
+            elif ord("0") <= escaped <= ord("7"):
+                digits_end = position - 1
+                while digits_end < min(position + 2, len(data)) and (
+                    ord("0") <= data[digits_end] <= ord("7")
+                ):
+                    digits_end += 1
+                digits_start = position - 1
+                output.append(int(data[digits_start:digits_end], 8) & 0xFF)
+                position = digits_end
+            elif escaped == ord("\r"):
+                # A backslash at the end of a line continues the string on the next one.
+                if data.startswith(b"\n", position):
+                    position += 1
+            elif escaped != ord("\n"):
+                output.append(escaped)
+        elif char == ord("("):
+            if depth:
+                output.append(char)
+            depth += 1
+        elif char == ord(")"):
+            depth -= 1
+            if not depth:
+                return bytes(output)
+            output.append(char)
+        else:
+            output.append(char)
+    raise MalformedPdfError("unterminated string")
+
+
+def _parse_string(data: bytes, position: int) -> bytes:
+    """Parses the literal or hexadecimal string that starts at `position`."""
+    if data.startswith(b"(", position):
+        return _parse_literal_string(data, position)
+    if data.startswith(b"<", position):
+        end = data.find(b">", position)
+        if end == -1:
+            raise MalformedPdfError("unterminated hexadecimal string")
+        digits_start = position + 1
+        digits = b"".join(data[digits_start:end].split())
+        if len(digits) % 2:
+            digits += b"0"
+        return bytes.fromhex(digits.decode("ascii"))
+    raise MalformedPdfError("expected a string")
+
+
+def _decode_text_string(data: bytes) -> str:
+    if data.startswith(b"\xfe\xff"):
+        return data[2:].decode("utf-16-be", errors="replace")
+    if data.startswith(b"\xef\xbb\xbf"):
+        return data[3:].decode("utf-8", errors="replace")
+    return decode_pdfdocencoding(data)
+
+
+def _read_page_count(reader: _XrefReader, sections: list[tuple[int, bool]]) -> int:
+    assert reader.root is not None
+    catalog = reader.read_object(sections, reader.root)
+    pages = reader.read_object(sections, _search(_PAGES_RE, catalog))
+    if _PAGES_TYPE_RE.search(pages) is None:
+        raise MalformedPdfError("root of the page tree is not a /Pages node")
+    count_match = _COUNT_RE.search(pages)
+    if count_match is None:
+        raise MalformedPdfError("/Count not found")
+    if count_match.group(2) is None:
+        return int(count_match.group(1))
+    # The /Count is a reference to an integer object.
+    count = reader.read_object(sections, int(count_match.group(1))).strip()
+    if not count.isdigit():
+        raise MalformedPdfError("/Count is not an integer")
+    return int(count)
+
+
+def _read_title(reader: _XrefReader, sections: list[tuple[int, bool]]) -> Optional[str]:
+    """Reads the /Title of the document information dictionary, if it has one."""
+    # The strings of encrypted files are encrypted too.
+    if reader.info is None or reader.encrypted:
+        return None
+    info = reader.read_object(sections, reader.info)
+    title_match = _TITLE_RE.search(info)
+    if title_match is None:
+        return None
+    reference_match = _REFERENCE_RE.match(info, title_match.end())
+    if reference_match is not None:
+        value = reader.read_object(sections, int(reference_match.group(1)))
+        title = _parse_string(value, len(value) - len(value.lstrip()))
+    else:
+        title = _parse_string(info, title_match.end())
+    return _decode_text_string(title)
+
+
+def count_pages_from_xref(mm: mmap.mmap) -> int:
+    """Reads the page count from the /Count of the root of the page tree."""
+    reader = _XrefReader(mm)
+    return _read_page_count(reader, reader.sections())
+
+
+def read_page_count_and_title_from_xref(mm: mmap.mmap) -> tuple[int, Optional[str]]:
+    """Reads the page count like `count_pages_from_xref`, and the title of the pdf.
+
+    A title that can't be read is returned as None rather than failing the page count.
+
+    """
+    reader = _XrefReader(mm)
+    sections = reader.sections()
+    num_pages = _read_page_count(reader, sections)
+    try:
+        title = _read_title(reader, sections)
+    except (MalformedPdfError, ValueError, IndexError, zlib.error):
+        title = None
+    return num_pages, title
+
+
+def count_pages(file: Union[str, IO[bytes]]) -> int:
+    """Counts the pages of a pdf, given its path or a file object backed by a real file.
+
+    Only the xref and the root of the page tree are read. If those are damaged, the whole
+    document is parsed with PyPDF2 instead.
+
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return count_pages(f)
+
+    try:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return count_pages_from_xref(mm)
+    except (MalformedPdfError, ValueError, IndexError, zlib.error):
+        file.seek(0)
+        return len(PdfReader(file).pages)
+
+
+def read_page_count_and_title(file: Union[str, IO[bytes]]) -> tuple[int, Optional[str]]:
+    """Like `count_pages`, but also returns the title of the pdf, or None if it has none."""
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return read_page_count_and_title(f)
+
+    try:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return read_page_count_and_title_from_xref(mm)
+    except (MalformedPdfError, ValueError, IndexError, zlib.error):
+        file.seek(0)
+        reader = PdfReader(file)
+        title = reader.metadata.title if reader.metadata is not None else None
+        return len(reader.pages), title
@@ -1,17 +1,71 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
 import re
-from typing import AsyncIterable
+from enum import Enum
+from typing import AsyncIterable, Optional
 
 import fastapi_poe as fp
 from modal import App, Image, asgi_app
 
+from stream_utils import (
+    CodeFenceStripper,
+    StreamCollector,
+    collect_text,
+    strip_code_fences,
+)
+from tool_cache import ToolCache
+
 # TODO: set your bot access key and bot name for full functionality
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
 bot_name = ""
 
+# Number of code candidates that are generated and run concurrently. The first one that
+# runs without an error is kept. Set to 1 to generate a single candidate.
+NUM_CANDIDATES = 2
+# Maximum number of times Claude is asked to fix code that failed to run.
+MAX_DEBUG_ROUNDS = 2
+# Python outputs are cached by conversation and normalized code, so identical code isn't
+# run twice in a conversation.
+MAX_CACHED_RESULTS = 1024
+CACHED_RESULT_TTL = 60 * 60
+
+TRACEBACK_PATTERN = re.compile(r"^Traceback \(most recent call last\):", re.MULTILINE)
+# Syntax errors are reported without a traceback header, starting with the file location.
+FILE_LOCATION_PATTERN = re.compile(r'^\s*File ".*", line \d+', re.MULTILINE)
+# The message of the Python bot when code runs for too long, which is a whole line of its
+# output. Output of the code that merely starts with "Timed out" is not a timeout.
+TIMEOUT_PATTERN = re.compile(
+    r"^(?:Error: )?(?:Code e|E)xecution timed out(?: after [\d.]+ seconds?)?\.?[ \t]*$",
+    re.MULTILINE | re.IGNORECASE,
+)
+
+
+class ErrorKind(Enum):
+    SYNTAX = "a syntax error"
+    IMPORT = "an import error"
+    TIMEOUT = "a timeout"
+    RUNTIME = "a runtime error"
+
+
+ERROR_KINDS_BY_EXCEPTION = {
+    "SyntaxError": ErrorKind.SYNTAX,
+    "IndentationError": ErrorKind.SYNTAX,
+    "TabError": ErrorKind.SYNTAX,
+    "ImportError": ErrorKind.IMPORT,
+    "ModuleNotFoundError": ErrorKind.IMPORT,
+    "TimeoutError": ErrorKind.TIMEOUT,
+}
+DEBUG_HINTS = {
+    ErrorKind.SYNTAX: "Make sure the code is valid Python.",
+    ErrorKind.IMPORT: "Only use the standard library and commonly installed packages.",
+    ErrorKind.TIMEOUT: "Make the code finish much faster.",
+    ErrorKind.RUNTIME: "Fix the cause of the exception.",
+}
+
 
 def override_message(request: fp.QueryRequest, message: str):
     new_query = request.model_copy(
@@ -20,15 +74,90 @@ def override_message(request: fp.QueryRequest, message: str):
     return new_query
 
 
+def clean_code(code: str) -> str:
+    # Remove code fences, in case Claude ignored the instructions.
+    return strip_code_fences(code).strip()
+
+
+def classify_error(python_result: str) -> Optional[ErrorKind]:
+    """Returns the kind of error in the output of the Python bot, if the code failed.
+
+    Output that merely contains a word like "Error:" is not an error; a failure needs a
+    traceback, a syntax error location, or a timeout message.
+
+    """
+    if TIMEOUT_PATTERN.search(python_result):
+        return ErrorKind.TIMEOUT
+    header = None
+    for pattern in (TRACEBACK_PATTERN, FILE_LOCATION_PATTERN):
+        for header in pattern.finditer(python_result):
+            pass
+        if header is not None:
+            break
+    if header is None:
+        return None
+    # The exception is on the first unindented line after the traceback frames.
+    frames_start = header.end()
+    for line in python_result[frames_start:].splitlines()[1:]:
+        if line.strip() and not line[0].isspace() and not line.startswith("```"):
+            exception_name = line.split(":", 1)[0].rsplit(".", 1)[-1].strip()
+            return ERROR_KINDS_BY_EXCEPTION.get(exception_name, ErrorKind.RUNTIME)
+    return ErrorKind.RUNTIME
+
+
+def normalize_code(code: str) -> str:
+    lines = (line.rstrip() for line in clean_code(code).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def result_cache_key(conversation_id: str, code: str) -> str:
+    digest = hashlib.sha256(normalize_code(code).encode()).hexdigest()
+    return f"{conversation_id}:{digest}"
+
+
+# Timeouts may not happen on a second run, so they are not cached.
+python_result_cache = ToolCache(
+    CACHED_RESULT_TTL,
+    MAX_CACHED_RESULTS,
+    should_cache=lambda result: classify_error(result) is not ErrorKind.TIMEOUT,
+)
+
+
+async def run_code(request: fp.QueryRequest, code: str) -> tuple[str, str]:
+    """Runs the code in the Python bot, returning the code and its output."""
+    python_result = await python_result_cache.get_or_call_async(
+        result_cache_key(request.conversation_id, code),
+        lambda: fp.get_final_response(
+            override_message(request, code), "Python", request.access_key
+        ),
+    )
+    return code, python_result
+
+
+async def generate_and_run_code(
+    request: fp.QueryRequest, prompt: str
+) -> tuple[str, str]:
+    """Generates a code candidate with Claude-3.5-Sonnet without streaming it, then runs it."""
+    code = await collect_text(
+        fp.stream_request(
+            override_message(request, prompt), "Claude-3.5-Sonnet", request.access_key
+        ),
+        CodeFenceStripper(),
+    )
+    return await run_code(request, code.strip())
+
+
 class CodeGenAndRunnerBot(fp.PoeBot):
     async def get_response(
         self, request: fp.QueryRequest
     ) -> AsyncIterable[fp.PartialResponse]:
         """
-        1. Call Claude-3.5-Sonnet to generate code based on the user's request.
-        2. Pass the returned code to the Python bot.
+        1. Call Claude-3.5-Sonnet to generate code based on the user's request. Extra
+           candidates are generated in the background at the same time.
+        2. Pass the returned code to the Python bot, and keep the first candidate that
+           runs without an error.
         3. If there's an error, call Claude-3.5-Sonnet again with the error message for debugging.
-        4. Re-run the updated code on the Python bot.
+        4. Re-run the updated code on the Python bot, for up to MAX_DEBUG_ROUNDS rounds.
         5. Return the final result (or last error if debugging failed).
         """
 
@@ -54,154 +183,184 @@ class CodeGenAndRunnerBot(fp.PoeBot):
             "explain the code."
         )
 
-        # Wrap the code in triple backticks for nice formatting
-        yield fp.PartialResponse(text="```python\n")
-        code_snippet = ""
-        async for msg in fp.stream_request(
-            override_message(request, gen_code_prompt),
-            "Claude-3.5-Sonnet",
-            request.access_key,
-        ):
-            if msg.text:
-                code_snippet += msg.text
-            yield fp.PartialResponse(text=msg.text)
-        yield fp.PartialResponse(text="\n```")
+        # The extra candidates are generated and run in the background while the first
+        # one is streamed to the user.
+        runs = [
+            asyncio.ensure_future(generate_and_run_code(request, gen_code_prompt))
+            for _ in range(NUM_CANDIDATES - 1)
+        ]
+        try:
+            # Wrap the code in triple backticks for nice formatting
+            yield fp.PartialResponse(text="```python\n")
+            # Code fences are stripped as they arrive, in case Claude ignored the
+            # instructions.
+            collector = StreamCollector(CodeFenceStripper())
+            async for msg in collector.forward(
+                fp.stream_request(
+                    override_message(request, gen_code_prompt),
+                    "Claude-3.5-Sonnet",
+                    request.access_key,
+                )
+            ):
+                yield fp.PartialResponse(text=msg.text)
+            yield fp.PartialResponse(text="\n```")
+            code_snippet = collector.text.strip()
 
-        # Clean up code snippet by removing triple backticks
-        # This is incase Claude ignored the instructions.
-        code_snippet = re.sub(r"```+", "", code_snippet).strip()
+            # -------------
+            # 2) Run the code in the Python bot
+            # -------------
+            yield fp.PartialResponse(text="\nRunning the code in Python...\n")
+            first_run = asyncio.ensure_future(run_code(request, code_snippet))
+            runs.insert(0, first_run)
 
-        # -------------
-        # 2) Run the code in the Python bot
-        # -------------
-        yield fp.PartialResponse(text="\nRunning the code in Python...\n")
+            # The first candidate that runs without an error. Failing that, the run of
+            # the code shown to the user, or else the last candidate that returned.
+            candidate = None
+            for next_run in asyncio.as_completed(runs):
+                try:
+                    returned = await next_run
+                except Exception:
+                    # A failed candidate is not fatal while others may still succeed.
+                    continue
+                if classify_error(returned[1]) is None:
+                    candidate = returned
+                    break
+                if candidate is None or candidate[0] != code_snippet:
+                    candidate = returned
+        finally:
+            for run in runs:
+                run.cancel()
+            await asyncio.gather(*runs, return_exceptions=True)
 
-        python_result = await fp.get_final_response(
-            override_message(request, code_snippet), "Python", request.access_key
-        )
+        if candidate is None:
+            # No candidate returned, so report the error of the one shown to the user.
+            candidate = first_run.result()
+        candidate_code, python_result = candidate
+        if candidate_code != code_snippet:
+            code_snippet = candidate_code
+            if classify_error(python_result) is None:
+                text = "\nAnother candidate ran successfully first:\n"
+            else:
+                text = "\nThe code above could not be run, so we debug this one:\n"
+            yield fp.PartialResponse(text=f"{text}```python\n{code_snippet}\n```\n")
 
-        # Check if Python returned an error by looking for "Traceback" or "Error" keywords
-        error_keywords = ["Traceback (most recent call last):", "Error:"]
-        has_error = any(keyword in python_result for keyword in error_keywords)
         yield fp.PartialResponse(text=f"Output of code:\n{python_result}")
 
         # -------------
-        # 3) If there's an error, call Claude to help debug
+        # 3) While there's an error, call Claude to help debug
         # -------------
-        if has_error:
+        original_code = code_snippet
+        tried_code = {normalize_code(code_snippet)}
+        error_kind = classify_error(python_result)
+        debug_round = 0
+        while error_kind is not None and debug_round < MAX_DEBUG_ROUNDS:
+            debug_round += 1
             yield fp.PartialResponse(
-                text="\nWe got an error when running the code. Asking "
-                "Claude-3.5-Sonnet to debug...\n"
+                text=f"\nWe got {error_kind.value} when running the code. Asking "
+                f"Claude-3.5-Sonnet to debug (attempt {debug_round} of "
+                f"{MAX_DEBUG_ROUNDS})...\n"
             )
 
             debug_prompt = (
-                "The following Python code produced an error. "
+                f"The following Python code produced {error_kind.value}. "
                 f"Original code:\n{code_snippet}\n\n"
                 f"Error:\n{python_result}\n\n"
+                f"{DEBUG_HINTS[error_kind]} "
                 "Please provide only the Python code (no markdown fences) needed to "
                 "fix the error."
                 " Do not include any comments or other text in the code. "
                 "Do not offer to explain the code."
             )
-            debug_code_snippet = ""
             yield fp.PartialResponse(text="```python\n")
-            async for msg in fp.stream_request(
-                override_message(request, debug_prompt),
-                "Claude-3.5-Sonnet",
-                request.access_key,
+            collector = StreamCollector(CodeFenceStripper())
+            async for msg in collector.forward(
+                fp.stream_request(
+                    override_message(request, debug_prompt),
+                    "Claude-3.5-Sonnet",
+                    request.access_key,
+                )
             ):
-                if msg.text:
-                    debug_code_snippet += msg.text
                 yield fp.PartialResponse(text=msg.text)
             yield fp.PartialResponse(text="\n```")
-            debug_code_snippet = re.sub(r"```+", "", debug_code_snippet).strip()
+            code_snippet = collector.text.strip()
+
+            # Running code that already failed would fail the same way again.
+            if normalize_code(code_snippet) in tried_code:
+                yield fp.PartialResponse(
+                    text="\nThe updated code was already tried, so we stop debugging.\n"
+                )
+                break
+            tried_code.add(normalize_code(code_snippet))
 
             yield fp.PartialResponse(
                 text="\nRe-running the updated code in Python...\n"
             )
+            _, python_result = await run_code(request, code_snippet)
+            yield fp.PartialResponse(text=f"Output of debugged code:\n{python_result}")
+            error_kind = classify_error(python_result)
 
-            python_debug_result = await fp.get_final_response(
-                override_message(request, debug_code_snippet),
-                "Python",
-                request.access_key,
-            )
-
+        # If we still have an error, just give up and display it
+        if error_kind is not None:
             yield fp.PartialResponse(
-                text=f"Output of debugged code:\n{python_debug_result}"
-            )
-
-            # If we still have error, just give up and display it
-            if any(kw in python_debug_result for kw in error_keywords):
-                yield fp.PartialResponse(
-                    text=(
-                        "It seems we have another error even after debugging:\n\n"
-                        f"{python_debug_result}\n\n"
-                        "You can try refining your request or debugging further."
-                    )
-                )
-                return
-            else:
-                # Summarize successful run with Claude:
-                yield fp.PartialResponse(
-                    text="\nDebugged code ran successfully. Summarizing the final output...\n"
-                )
-                # We'll make a request to Claude-3.5-Sonnet to summarize the result:
-                summary_prompt = (
-                    "The original user request was:\n"
-                    f"{user_message}\n\n"
-                    "The code that was generated and run was:\n"
-                    f"{code_snippet}\n\n"
-                    "But we got an error. So we debugged it and ran the following code:\n"
-                    f"{debug_code_snippet}\n\n"
-                    "The output of the code was:\n"
-                    f"{python_debug_result}\n\n"
-                    "Please summarize the output of the code, and whether it fulfilled the "
-                    "original request."
+                text=(
+                    "It seems we have an error even after debugging:\n\n"
+                    f"{python_result}\n\n"
+                    "You can try refining your request or debugging further."
                 )
+            )
+            return
 
-                async for msg in fp.stream_request(
-                    override_message(request, summary_prompt),
-                    "Claude-3.5-Sonnet",
-                    request.access_key,
-                ):
-                    yield fp.PartialResponse(text=msg.text)
-                return
-        else:
-            # -------------
-            # 4) If there's no error, summarize the result
-            # -------------
+        # -------------
+        # 4) If there's no error, summarize the result
+        # -------------
+        if debug_round == 0:
             yield fp.PartialResponse(
                 text="\nThe code ran successfully on the first try.\n"
             )
             yield fp.PartialResponse(
                 text="Asking Claude-3.5-Sonnet for a brief summary of the output...\n"
             )
-            summary_prompt = (
-                "The original user request was:\n"
-                f"{user_message}\n\n"
+            code_description = (
+                "The code that was generated and run was:\n" f"{code_snippet}\n\n"
+            )
+        else:
+            yield fp.PartialResponse(
+                text="\nDebugged code ran successfully. Summarizing the final output...\n"
+            )
+            code_description = (
                 "The code that was generated and run was:\n"
+                f"{original_code}\n\n"
+                "But we got an error. So we debugged it and ran the following code:\n"
                 f"{code_snippet}\n\n"
-                "The output of the code was:\n"
-                f"{python_result}\n\n"
-                "Please summarize the output of the code, and whether it fulfilled the "
-                "original request."
             )
+        summary_prompt = (
+            "The original user request was:\n"
+            f"{user_message}\n\n"
+            f"{code_description}"
+            "The output of the code was:\n"
+            f"{python_result}\n\n"
+            "Please summarize the output of the code, and whether it fulfilled the "
+            "original request."
+        )
 
-            async for msg in fp.stream_request(
-                override_message(request, summary_prompt),
-                "Claude-3.5-Sonnet",
-                request.access_key,
-            ):
-                yield fp.PartialResponse(text=msg.text)
+        async for msg in fp.stream_request(
+            override_message(request, summary_prompt),
+            "Claude-3.5-Sonnet",
+            request.access_key,
+        ):
+            yield fp.PartialResponse(text=msg.text)
 
     async def get_settings(self, setting: fp.SettingsRequest) -> fp.SettingsResponse:
         """
         We declare dependencies for:
-        - Claude-3.5-Sonnet (possibly: 3 calls in worst case).
-        - Python (possibly: 2 or 3 calls in worst case).
+        - Claude-3.5-Sonnet (one call per candidate and debug round, plus a summary).
+        - Python (one call per candidate and debug round).
         """
         return fp.SettingsResponse(
-            server_bot_dependencies={"Claude-3.5-Sonnet": 3, "Python": 3}
+            server_bot_dependencies={
+                "Claude-3.5-Sonnet": NUM_CANDIDATES + MAX_DEBUG_ROUNDS + 1,
+                "Python": NUM_CANDIDATES + MAX_DEBUG_ROUNDS,
+            }
         )
 
 
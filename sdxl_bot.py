@@ -7,14 +7,29 @@ Uses Fireworks AI and Stable Diffusion XL.
 """
 
 import asyncio
+import hashlib
 import io
+import json
 import os
 import random
-from typing import AsyncIterable, Optional, Union
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import fastapi_poe as fp
 import httpx
-from fastapi_poe import PoeBot
+from fastapi import FastAPI
 from fastapi_poe.types import (
     ErrorResponse,
     MetaResponse,
@@ -23,10 +38,11 @@ from fastapi_poe.types import (
     SettingsRequest,
     SettingsResponse,
 )
-from modal import App, Image, asgi_app
-from PIL import Image as PILImage
+from modal import App, Image, Volume, asgi_app
 from sse_starlette.sse import ServerSentEvent
 
+from attachment_upload import AttachmentUploader, StreamingUploadBot
+
 # TODO: set your bot access key, and fireworks api key, and bot name for this bot to work
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
@@ -40,82 +56,335 @@ FIREWORKS_SDXL_ENDPOINT = (
     "accounts/fireworks/models/stable-diffusion-xl-1024-v1-0"
 )
 
+# Users can ask for several variants with e.g. "a cat --variants 4" (different seeds) or
+# "a cat --aspect 1:1,16:9" (one variant per aspect ratio).
+MAX_VARIANTS = 4
+# Maximum number of concurrent Fireworks requests per container.
+MAX_CONCURRENT_GENERATIONS = 4
+VARIANTS_PATTERN = re.compile(r"--variants\s+(\d+)")
+ASPECT_RATIOS_PATTERN = re.compile(r"--aspect\s+(\d+:\d+(?:,\d+:\d+)*)")
+
+# Opt-in cache of generated images, keyed on the prompt, steps, aspect ratio and seed
+# policy. IMAGE_CACHE_SIZE is the number of images kept in memory (0 disables the cache).
+# Set IMAGE_CACHE_DIR to e.g. "/cache" to also keep the images on a Modal volume.
+IMAGE_CACHE_SIZE = 0
+IMAGE_CACHE_DIR: Optional[str] = None
+
+# Seconds between progress updates while the image is being generated.
+HEARTBEAT_INTERVAL = 1.0
+
+# Optional post-processing of the generated image, e.g. (512, 512) or "PNG". When all of
+# these are None, the JPEG returned by Fireworks is uploaded as is, without re-encoding it.
+OUTPUT_SIZE: Optional[Tuple[int, int]] = None
+THUMBNAIL_SIZE: Optional[Tuple[int, int]] = None
+OUTPUT_FORMAT: Optional[str] = None
+
+# Connection pool and timeouts (in seconds) for the requests to Fireworks.
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 60.0
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+
+
+def make_http_client(
+    connect_timeout: float = CONNECT_TIMEOUT,
+    read_timeout: float = READ_TIMEOUT,
+    max_connections: int = MAX_CONNECTIONS,
+    max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+) -> httpx.AsyncClient:
+    """Creates a pooled HTTP/2 client meant to be shared by all requests of the app."""
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        ),
+    )
+
+
+def transform_image(
+    image_bytes: bytes,
+    size: Optional[Tuple[int, int]] = OUTPUT_SIZE,
+    thumbnail_size: Optional[Tuple[int, int]] = THUMBNAIL_SIZE,
+    image_format: Optional[str] = OUTPUT_FORMAT,
+) -> Tuple[bytes, str]:
+    """Applies the requested transforms and returns the image bytes and file extension.
+
+    The original bytes are passed through untouched when no transform is requested.
+
+    """
+    if size is None and thumbnail_size is None and image_format is None:
+        return image_bytes, "jpg"
+
+    from PIL import Image as PILImage
+
+    image = PILImage.open(io.BytesIO(image_bytes))
+    image_format = image_format or image.format or "JPEG"
+    if size is not None:
+        image = image.resize(size)
+    if thumbnail_size is not None:
+        image.thumbnail(thumbnail_size)
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue(), image_format.lower()
+
+
+class ImageUploadError(Exception):
+    pass
+
+
+class ImageCache:
+    """LRU cache of encoded image bytes, with an optional on-disk tier."""
+
+    def __init__(self, max_entries: int, directory: Optional[str] = None) -> None:
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(prompt: str, steps: int, aspect_ratio: str, seed_policy: str) -> str:
+        key_data = json.dumps([prompt, steps, aspect_ratio, seed_policy])
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, f"{key}.img")
+
+    def _read_file(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_file(self, key: str, data: bytes) -> None:
+        # Write to a temporary file first so readers never see a partial image.
+        temp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self._path(key))
+
+    def _remember(self, key: str, data: bytes) -> None:
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        elif self.directory is not None:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(None, self._read_file, key)
+            if data is not None:
+                self._remember(key, data)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    async def put(self, key: str, data: bytes) -> None:
+        self._remember(key, data)
+        if self.directory is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write_file, key, data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+def parse_prompt(text: str) -> Tuple[str, List[str]]:
+    """Strips the variant options from the prompt and returns one aspect ratio per variant."""
+    aspect_ratios = [ASPECT_RATIO]
+    aspect_ratios_match = ASPECT_RATIOS_PATTERN.search(text)
+    if aspect_ratios_match:
+        aspect_ratios = aspect_ratios_match.group(1).split(",")
+    num_variants = len(aspect_ratios)
+    variants_match = VARIANTS_PATTERN.search(text)
+    if variants_match:
+        num_variants = max(1, int(variants_match.group(1)))
+    num_variants = min(num_variants, MAX_VARIANTS)
+
+    prompt = ASPECT_RATIOS_PATTERN.sub("", VARIANTS_PATTERN.sub("", text)).strip()
+    return prompt, [aspect_ratios[i % len(aspect_ratios)] for i in range(num_variants)]
+
+
+class SDXLBot(StreamingUploadBot):
+    # Set when the app starts up (see `fastapi_app` below) and reused across requests.
+    http_client: Optional[httpx.AsyncClient] = None
+    # Limits the concurrent Fireworks requests across all requests to this container.
+    generation_semaphore: Optional[asyncio.Semaphore] = None
+    # Set when the app starts up if IMAGE_CACHE_SIZE > 0.
+    image_cache: Optional[ImageCache] = None
 
-class SDXLBot(PoeBot):
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
         return SettingsResponse(enable_multi_entity_prompting=True)
 
     async def _generate_image_async(
-        self, prompt: str, aspect_ratio: Optional[str] = ASPECT_RATIO
-    ) -> Optional[PILImage.Image]:
-        async with httpx.AsyncClient(timeout=None) as client:
-            url = FIREWORKS_SDXL_ENDPOINT
-            headers = {
-                "Authorization": f"Bearer {fireworks_api_key}",
-                "Content-Type": "application/json",
-                "Accept": "image/jpeg",
-            }
-            json_data = {
-                "prompt": prompt,
-                "steps": NUM_STEPS,
-                "seed": random.randint(0, 2**32 - 1),
-            }
-
-            if aspect_ratio is not None:
-                json_data["aspect_ratio"] = aspect_ratio
-
-            try:
-                response = await client.post(url, headers=headers, json=json_data)
-                response.raise_for_status()
-
-                image_bytes = io.BytesIO(response.content)
-                image = PILImage.open(image_bytes)
-                return image
-
-            except Exception as e:
-                print(e)
+        self,
+        prompt: str,
+        aspect_ratio: Optional[str] = ASPECT_RATIO,
+        on_progress: Optional[Callable[[str], None]] = None,
+    ) -> Optional[bytes]:
+        # The Fireworks endpoint does not report progress. If you switch to a provider that
+        # does, pass its status messages (e.g. "Step 10/50") to `on_progress`.
+        if self.http_client is None:
+            self.http_client = make_http_client()
+        client = self.http_client
+        url = FIREWORKS_SDXL_ENDPOINT
+        headers = {
+            "Authorization": f"Bearer {fireworks_api_key}",
+            "Content-Type": "application/json",
+            "Accept": "image/jpeg",
+        }
+        json_data = {
+            "prompt": prompt,
+            "steps": NUM_STEPS,
+            "seed": random.randint(0, 2**32 - 1),
+        }
+
+        if aspect_ratio is not None:
+            json_data["aspect_ratio"] = aspect_ratio
+
+        try:
+            response = await client.post(url, headers=headers, json=json_data)
+            response.raise_for_status()
+            return response.content
+
+        except Exception as e:
+            print(e)
+            return None
+
+    async def _generate_and_upload_image(
+        self,
+        query: QueryRequest,
+        prompt: str,
+        aspect_ratio: str,
+        variant_index: int,
+        filename_stem: str,
+        on_progress: Callable[[str], None],
+    ) -> Optional[str]:
+        """Generates one image, uploads it and returns its markdown, or None on failure."""
+        # Seeds are random, so each variant of a prompt gets its own cache entry.
+        cache_key = ImageCache.make_key(
+            prompt, NUM_STEPS, aspect_ratio, f"random-{variant_index}"
+        )
+        result = None
+        if self.image_cache is not None:
+            result = await self.image_cache.get(cache_key)
+
+        if result is None:
+            if self.generation_semaphore is None:
+                self.generation_semaphore = asyncio.Semaphore(
+                    MAX_CONCURRENT_GENERATIONS
+                )
+            async with self.generation_semaphore:
+                result = await self._generate_image_async(
+                    prompt, aspect_ratio, on_progress=on_progress
+                )
+            if result is None:
                 return None
+            if self.image_cache is not None:
+                await self.image_cache.put(cache_key, result)
+
+        image_bytes, extension = transform_image(result)
+        filename = f"{filename_stem}.{extension}"
+        try:
+            attachment_upload_response = await self.post_message_attachment(
+                message_id=query.message_id,
+                file_data=image_bytes,
+                filename=filename,
+                is_inline=True,
+            )
+        except Exception as e:
+            raise ImageUploadError() from e
+        if not attachment_upload_response.inline_ref:
+            raise ImageUploadError()
+        return f"![{filename}][{attachment_upload_response.inline_ref}]"
 
     async def get_response(
         self, query: QueryRequest
     ) -> AsyncIterable[Union[PartialResponse, ServerSentEvent]]:
-        """Uses the latest chat message as a prompt to generate an image."""
+        """Uses the latest chat message as a prompt to generate one or more images."""
         # disable suggested replies
         yield MetaResponse(text="", suggested_replies=False)
 
-        user_message = query.query[-1].content
-        inference_task = asyncio.create_task(self._generate_image_async(user_message))
+        prompt, aspect_ratios = parse_prompt(query.query[-1].content)
+        progress: asyncio.Queue = asyncio.Queue()
+        inference_tasks = [
+            asyncio.create_task(
+                self._generate_and_upload_image(
+                    query,
+                    prompt,
+                    aspect_ratio,
+                    variant_index=i,
+                    filename_stem="image" if len(aspect_ratios) == 1 else f"image_{i}",
+                    on_progress=progress.put_nowait,
+                )
+            )
+            for i, aspect_ratio in enumerate(aspect_ratios, start=1)
+        ]
+        progress_task = asyncio.ensure_future(progress.get())
 
         try:
-            inference_task_timer = 0
-            while not inference_task.done():
-                yield self.replace_response_event(
-                    text=f"Generating image... ({inference_task_timer} seconds)"
+            start_time = time.monotonic()
+            status = "Generating image..."
+            if len(inference_tasks) > 1:
+                status = f"Generating {len(inference_tasks)} images..."
+            images: List[Optional[str]] = [None] * len(inference_tasks)
+            num_upload_errors = 0
+            pending = set(inference_tasks)
+            yield self.replace_response_event(text=f"{status} (0 seconds)")
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending | {progress_task},
+                    timeout=HEARTBEAT_INTERVAL,
+                    return_when=asyncio.FIRST_COMPLETED,
                 )
-                await asyncio.sleep(1)
-                inference_task_timer += 1
-
-            result = await inference_task
-            if isinstance(result, PILImage.Image):
-                img_byte_arr = io.BytesIO()
-                result.save(img_byte_arr, format=result.format)
-                img_byte_arr = img_byte_arr.getvalue()
-                attachment_upload_response = await self.post_message_attachment(
-                    message_id=query.message_id,
-                    file_data=img_byte_arr,
-                    filename="image.jpg",
-                    is_inline=True,
+                if progress_task in done:
+                    status = progress_task.result()
+                    progress_task = asyncio.ensure_future(progress.get())
+                for task in done & pending:
+                    pending.discard(task)
+                    try:
+                        images[inference_tasks.index(task)] = task.result()
+                    except ImageUploadError as e:
+                        # Like a failed generation, this only loses this one variant.
+                        print(e.__cause__ or e)
+                        num_upload_errors += 1
+                if not pending:
+                    break
+                elapsed = int(time.monotonic() - start_time)
+                finished_images = [image for image in images if image]
+                yield self.replace_response_event(
+                    text="\n\n".join(
+                        [*finished_images, f"{status} ({elapsed} seconds)"]
+                    )
                 )
-                if not attachment_upload_response.inline_ref:
+
+            finished_images = [image for image in images if image]
+            if not finished_images:
+                if num_upload_errors == len(images):
                     yield ErrorResponse(
                         text="Error uploading image to Poe.", allow_retry=True
                     )
-                    return
-                output_md = f"![image.jpg][{attachment_upload_response.inline_ref}]"
-                yield PartialResponse(text=output_md, is_replace_response=True)
-            else:
-                yield ErrorResponse(text="Error generating image.", allow_retry=True)
+                else:
+                    yield ErrorResponse(
+                        text="Error generating image.", allow_retry=True
+                    )
                 return
+            output_md = "\n\n".join(finished_images)
+            num_failed = len(images) - len(finished_images)
+            if num_failed:
+                output_md += f"\n\n{num_failed} of the images could not be generated."
+            yield PartialResponse(text=output_md, is_replace_response=True)
         except Exception as e:
             yield ErrorResponse(
                 text="The bot ran into an unexpected error.",
@@ -123,25 +392,55 @@ class SDXLBot(PoeBot):
                 allow_retry=True,
             )
             return
+        finally:
+            progress_task.cancel()
+            for task in inference_tasks:
+                task.cancel()
 
 
-REQUIREMENTS = ["fastapi-poe", "pillow"]
+# StreamingUploadBot needs the _upload_file hook of fastapi-poe 0.0.82 and later.
+REQUIREMENTS = ["fastapi-poe==0.0.83", "httpx[http2]", "pillow"]
 image = (
     Image.debian_slim()
     .pip_install(*REQUIREMENTS)
     .env({"FIREWORKS_API_KEY": fireworks_api_key, "POE_ACCESS_KEY": bot_access_key})
 )
 app = App("sdxlbot-poe")
+image_cache_volume = Volume.from_name("sdxlbot-image-cache", create_if_missing=True)
 
 
-@app.function(image=image)
+@app.function(
+    image=image,
+    volumes={IMAGE_CACHE_DIR: image_cache_volume} if IMAGE_CACHE_DIR else {},
+)
 @asgi_app()
 def fastapi_app():
     bot = SDXLBot()
+    if IMAGE_CACHE_SIZE > 0:
+        bot.image_cache = ImageCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_DIR)
+
+    @asynccontextmanager
+    async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+        bot.http_client = make_http_client()
+        bot.uploader = AttachmentUploader()
+        try:
+            yield
+        finally:
+            await bot.http_client.aclose()
+            bot.http_client = None
+            await bot.uploader.aclose()
+            bot.uploader = None
+
     app = fp.make_app(
         bot,
         access_key=bot_access_key,
         bot_name=bot_name,
         allow_without_key=not (bot_access_key and bot_name),
+        app=FastAPI(lifespan=lifespan),
     )
+
+    @app.get("/image_cache_stats")
+    async def image_cache_stats() -> Dict[str, int]:
+        return bot.image_cache.stats() if bot.image_cache is not None else {}
+
     return app
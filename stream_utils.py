@@ -0,0 +1,170 @@
+"""
+
+Helpers for working with streams of responses, shared by the sample bots.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import re
+from typing import AsyncIterable, AsyncIterator, Optional, Protocol, TypeVar
+
+import fastapi_poe as fp
+
+T = TypeVar("T")
+
+_STREAM_DONE = object()
+
+# A markdown code fence, with its language tag and the rest of its line. Fences start a
+# line, so backticks inside code, such as in a string literal, are left alone.
+CODE_FENCE_PATTERN = re.compile(r"^[ \t]*`{3,}[\w+-]*[ \t]*\n?", re.MULTILINE)
+# The last line of a chunk, which could still turn out to be a code fence.
+PARTIAL_CODE_FENCE_PATTERN = re.compile(r"^[ \t]*`*[\w+-]*[ \t]*\Z", re.MULTILINE)
+
+
+async def merge_streams(*streams: AsyncIterator[T]) -> AsyncIterator[tuple[int, T]]:
+    """Fans in several streams, yielding `(index, item)` pairs as soon as any stream produces.
+
+    Each stream is drained by its own long-lived task into a single shared queue, so every
+    stream moves at its own pace and a slow stream never holds back a fast one. If a stream
+    raises, the exception is re-raised to the consumer. Any remaining tasks are cancelled when
+    the consumer stops iterating.
+
+    """
+    queue: asyncio.Queue[tuple[int, object, Exception | None]] = asyncio.Queue()
+
+    async def _drain(index: int, stream: AsyncIterator[T]) -> None:
+        try:
+            async for item in stream:
+                await queue.put((index, item, None))
+        except Exception as e:
+            await queue.put((index, _STREAM_DONE, e))
+        else:
+            await queue.put((index, _STREAM_DONE, None))
+
+    tasks = [
+        asyncio.ensure_future(_drain(index, stream))
+        for index, stream in enumerate(streams)
+    ]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            index, item, error = await queue.get()
+            if error is not None:
+                raise error
+            elif item is _STREAM_DONE:
+                remaining -= 1
+            else:
+                yield index, item  # type: ignore[misc]
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class StreamTransform(Protocol):
+    """Transforms the text of a stream chunk by chunk.
+
+    A transform may hold back the end of a chunk until it has seen more of the stream;
+    `flush` returns whatever is still held back once the stream ends.
+
+    """
+
+    def __call__(self, chunk: str) -> str: ...
+
+    def flush(self) -> str: ...
+
+
+def strip_code_fences(text: str) -> str:
+    return CODE_FENCE_PATTERN.sub("", text)
+
+
+class CodeFenceStripper:
+    """Removes markdown code fences from streamed text, even when split across chunks."""
+
+    def __init__(self) -> None:
+        self.pending = ""
+        # Whether the next chunk starts a line, and so could start with a code fence.
+        self.at_line_start = True
+
+    def __call__(self, chunk: str) -> str:
+        text = self.pending + chunk
+        at_line_start = self.at_line_start or bool(self.pending)
+        self.pending = ""
+        partial = PARTIAL_CODE_FENCE_PATTERN.search(text)
+        if partial is not None and (partial.start() > 0 or at_line_start):
+            fence = partial.group().lstrip(" \t")
+            if fence.startswith("```") or fence.strip("`") == "":
+                self.pending = partial.group()
+                text = text[: partial.start()]
+        if text:
+            self.at_line_start = text.endswith("\n")
+        return self._strip(text, at_line_start)
+
+    def flush(self) -> str:
+        text = self._strip(self.pending, True)
+        self.pending = ""
+        self.at_line_start = True
+        return text
+
+    @staticmethod
+    def _strip(text: str, at_line_start: bool) -> str:
+        if at_line_start:
+            return strip_code_fences(text)
+        # The first line continues the previous chunk, so it can't be a code fence.
+        first_line, newline, rest = text.partition("\n")
+        return first_line + newline + strip_code_fences(rest)
+
+
+class StreamCollector:
+    """Forwards a stream of responses while collecting its text.
+
+    The chunks are collected into a list and joined once, when `text` is first read after
+    the stream ends. An optional transform is applied to the text of each chunk before it
+    is forwarded and collected.
+
+    """
+
+    def __init__(self, transform: Optional[StreamTransform] = None) -> None:
+        self.transform = transform
+        self.chunks: list[str] = []
+        self._text: Optional[str] = None
+
+    async def forward(
+        self, stream: AsyncIterable[fp.PartialResponse]
+    ) -> AsyncIterator[fp.PartialResponse]:
+        async for msg in stream:
+            if msg.text and self.transform is not None:
+                text = self.transform(msg.text)
+                if text != msg.text:
+                    msg = msg.model_copy(update={"text": text})
+            if msg.is_replace_response:
+                self.chunks.clear()
+            if msg.text:
+                self.chunks.append(msg.text)
+                self._text = None
+            yield msg
+        if self.transform is not None:
+            text = self.transform.flush()
+            if text:
+                self.chunks.append(text)
+                self._text = None
+                yield fp.PartialResponse(text=text)
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "".join(self.chunks)
+        return self._text
+
+
+async def collect_text(
+    stream: AsyncIterable[fp.PartialResponse],
+    transform: Optional[StreamTransform] = None,
+) -> str:
+    """Returns the full text of a stream of responses, without forwarding it."""
+    collector = StreamCollector(transform)
+    async for _ in collector.forward(stream):
+        pass
+    return collector.text
@@ -0,0 +1,181 @@
+"""
+
+Memoizing cache for the tools of the function calling bots.
+
+Decorate a tool with `cached_tool` to cache its results by tool name and arguments for a
+while. Concurrent calls with the same arguments share a single upstream call.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# All caches created by `cached_tool`, by tool name.
+tool_caches: dict[str, ToolCache] = {}
+
+
+class ToolCache:
+    """TTL cache of tool results with single-flight deduplication of concurrent calls.
+
+    If `should_cache` is given, results for which it returns False are shared with the
+    calls already waiting for them, but are not cached for later calls.
+
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int,
+        should_cache: Optional[Callable[[Any], bool]] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.should_cache = should_cache
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        self._async_in_flight: dict[str, asyncio.Future[Any]] = {}
+        self._sync_in_flight: dict[str, concurrent.futures.Future[Any]] = {}
+
+    @staticmethod
+    def make_key(
+        name: str, signature: inspect.Signature, args: tuple, kwargs: dict
+    ) -> str:
+        """Normalizes the arguments of a call, so equivalent calls get the same key."""
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = json.dumps(
+            bound.arguments, sort_keys=True, separators=(",", ":"), default=str
+        )
+        return f"{name}:{arguments}"
+
+    def _get(self, key: str) -> tuple[bool, Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return False, None
+        self.entries.move_to_end(key)
+        return True, value
+
+    def _put(self, key: str, value: Any) -> None:
+        if self.should_cache is not None and not self.should_cache(value):
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_or_call(self, key: str, call: Callable[[], Any]) -> Any:
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                self.hits += 1
+                return value
+            in_flight = self._sync_in_flight.get(key)
+            if in_flight is None:
+                self.misses += 1
+                future: concurrent.futures.Future[Any] = concurrent.futures.Future()
+                self._sync_in_flight[key] = future
+            else:
+                self.deduplicated += 1
+        if in_flight is not None:
+            return in_flight.result()
+
+        try:
+            value = call()
+        except BaseException as e:
+            with self._lock:
+                del self._sync_in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._put(key, value)
+            del self._sync_in_flight[key]
+        future.set_result(value)
+        return value
+
+    async def get_or_call_async(
+        self, key: str, call: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                self.hits += 1
+                return value
+        task = self._async_in_flight.get(key)
+        if task is not None:
+            self.deduplicated += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(call())
+            self._async_in_flight[key] = task
+            task.add_done_callback(functools.partial(self._on_async_done, key))
+        # Shield the shared call so that a caller timing out doesn't cancel it for others.
+        return await asyncio.shield(task)
+
+    def _on_async_done(self, key: str, task: asyncio.Future[Any]) -> None:
+        del self._async_in_flight[key]
+        if not task.cancelled() and task.exception() is None:
+            with self._lock:
+                self._put(key, task.result())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "entries": len(self.entries),
+        }
+
+
+def cached_tool(ttl: float = 300.0, max_entries: int = 1024) -> Callable[[F], F]:
+    """Caches the results of a sync or async tool for `ttl` seconds.
+
+    The wrapped tool keeps its name, so it can still be passed to `fp.stream_request` as
+    one of the `tool_executables`.
+
+    """
+
+    def decorator(tool: F) -> F:
+        cache = ToolCache(ttl, max_entries)
+        tool_caches[tool.__name__] = cache
+        signature = inspect.signature(tool)
+
+        if inspect.iscoroutinefunction(tool):
+
+            @functools.wraps(tool)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                key = ToolCache.make_key(tool.__name__, signature, args, kwargs)
+                return await cache.get_or_call_async(key, lambda: tool(*args, **kwargs))
+
+            return async_wrapper  # type: ignore[return-value]
+
+        @functools.wraps(tool)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            key = ToolCache.make_key(tool.__name__, signature, args, kwargs)
+            return cache.get_or_call(key, lambda: tool(*args, **kwargs))
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def get_tool_cache_stats() -> dict[str, dict[str, int]]:
+    """Returns the cache statistics of every cached tool, by tool name."""
+    return {name: cache.stats() for name, cache in tool_caches.items()}
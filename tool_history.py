@@ -0,0 +1,175 @@
+"""
+
+Storage of the tool calls and results of FunctionCallingLoopBot across conversation turns.
+
+The tool messages of a turn are stored in the metadata of the bot's response, as
+zlib-compressed compact JSON encoded with base64 and prefixed with a schema version.
+Decoded messages are cached per conversation, so earlier turns are not decoded and
+validated again on every new turn. Once the context gets too long, old tool exchanges are
+collapsed into short summaries by `compact_tool_context`.
+
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import zlib
+from collections import OrderedDict
+from typing import Sequence
+
+import fastapi_poe as fp
+
+METADATA_VERSION = 1
+MAX_CACHED_CONVERSATIONS = 256
+# Maximum length of the summary of a collapsed tool exchange, in characters.
+MAX_SUMMARY_LENGTH = 200
+
+
+class UnsupportedMetadataVersionError(Exception):
+    pass
+
+
+def encode_tool_messages(messages: Sequence[fp.ProtocolMessage]) -> str:
+    payload = json.dumps(
+        [
+            message.model_dump(mode="json", exclude_defaults=True)
+            for message in messages
+        ],
+        separators=(",", ":"),
+    )
+    encoded = base64.b64encode(zlib.compress(payload.encode())).decode()
+    return f"v{METADATA_VERSION}:{encoded}"
+
+
+def decode_tool_messages(metadata: str) -> list[fp.ProtocolMessage]:
+    version, separator, encoded = metadata.partition(":")
+    if separator and version == f"v{METADATA_VERSION}":
+        message_dicts = json.loads(zlib.decompress(base64.b64decode(encoded)))
+    elif metadata.startswith("["):
+        # Metadata written before it was versioned is a plain JSON list.
+        message_dicts = json.loads(metadata)
+    else:
+        raise UnsupportedMetadataVersionError(version)
+    return [
+        fp.ProtocolMessage.model_validate(message_dict)
+        for message_dict in message_dicts
+    ]
+
+
+class ToolHistoryCache:
+    """Caches the expanded messages of each conversation, by message id."""
+
+    def __init__(self, max_conversations: int) -> None:
+        self.max_conversations = max_conversations
+        self.conversations: OrderedDict[str, dict[str, list[fp.ProtocolMessage]]] = (
+            OrderedDict()
+        )
+
+    def expand_query(self, request: fp.QueryRequest) -> list[fp.ProtocolMessage]:
+        """Returns the query with the stored tool messages inserted before each response."""
+        conversation = self.conversations.setdefault(request.conversation_id, {})
+        self.conversations.move_to_end(request.conversation_id)
+        while len(self.conversations) > self.max_conversations:
+            self.conversations.popitem(last=False)
+
+        expanded_messages: list[fp.ProtocolMessage] = []
+        for msg in request.query:
+            if msg.metadata is None:
+                expanded_messages.append(msg)
+                continue
+            cache_key = msg.message_id or msg.metadata
+            expanded = conversation.get(cache_key)
+            if expanded is None:
+                expanded = [
+                    *decode_tool_messages(msg.metadata),
+                    msg.model_copy(update={"metadata": None}),
+                ]
+                conversation[cache_key] = expanded
+            expanded_messages.extend(expanded)
+        return expanded_messages
+
+
+tool_history_cache = ToolHistoryCache(MAX_CACHED_CONVERSATIONS)
+
+
+def estimate_tokens(message: fp.ProtocolMessage) -> int:
+    """Roughly estimates the tokens of a message, at about 4 characters per token."""
+    return len(message.content) // 4 + 4
+
+
+def summarize_tool_exchange(
+    tool_call_message: fp.ProtocolMessage, tool_result_message: fp.ProtocolMessage
+) -> str:
+    """Returns a one line summary of a tool call message and its tool result message."""
+    try:
+        tool_calls = json.loads(tool_call_message.content)
+        tool_results = json.loads(tool_result_message.content)
+        results_by_id = {result["tool_call_id"]: result for result in tool_results}
+        summaries = []
+        for tool_call in tool_calls:
+            result = results_by_id.get(tool_call["id"], {}).get("content", "")
+            function = tool_call["function"]
+            summaries.append(f"{function['name']}({function['arguments']}) -> {result}")
+        summary = "; ".join(summaries)
+    except (ValueError, KeyError, TypeError):
+        summary = tool_result_message.content
+    if len(summary) > MAX_SUMMARY_LENGTH:
+        summary = summary[: MAX_SUMMARY_LENGTH - 3] + "..."
+    return f"[Tool calls: {summary}]"
+
+
+def compact_tool_context(
+    messages: Sequence[fp.ProtocolMessage], token_budget: int, keep_recent: int
+) -> list[fp.ProtocolMessage]:
+    """Collapses old tool exchanges into short summaries once over the token budget.
+
+    A tool exchange is a function call message followed by its tool result message. The
+    `keep_recent` most recent exchanges are always kept as is. Older exchanges are
+    collapsed, oldest first, into a one line summary that is prepended to the bot
+    response that followed them, until the context fits in `token_budget`.
+
+    """
+    token_counts = [estimate_tokens(message) for message in messages]
+    total_tokens = sum(token_counts)
+    if total_tokens <= token_budget:
+        return list(messages)
+
+    # Map each tool exchange to the bot response that follows it.
+    exchanges: list[tuple[int, int]] = []
+    pending_exchanges: list[int] = []
+    for i, message in enumerate(messages):
+        if (
+            message.message_type == "function_call"
+            and i + 1 < len(messages)
+            and messages[i + 1].role == "tool"
+        ):
+            pending_exchanges.append(i)
+        elif message.role == "bot" and message.message_type is None:
+            exchanges.extend((exchange, i) for exchange in pending_exchanges)
+            pending_exchanges = []
+    # Exchanges of the current turn have no response yet and are never collapsed.
+    num_collapsible = max(
+        0, len(exchanges) - max(0, keep_recent - len(pending_exchanges))
+    )
+
+    summaries: dict[int, list[str]] = {}
+    collapsed: set[int] = set()
+    for exchange, response in exchanges[:num_collapsible]:
+        if total_tokens <= token_budget:
+            break
+        summary = summarize_tool_exchange(messages[exchange], messages[exchange + 1])
+        summaries.setdefault(response, []).append(summary)
+        collapsed.update((exchange, exchange + 1))
+        total_tokens -= token_counts[exchange] + token_counts[exchange + 1]
+        total_tokens += len(summary) // 4
+
+    compacted = []
+    for i, message in enumerate(messages):
+        if i in collapsed:
+            continue
+        if i in summaries:
+            content = "\n".join([*summaries[i], message.content])
+            message = message.model_copy(update={"content": content})
+        compacted.append(message)
+    return compacted
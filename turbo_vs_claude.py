@@ -2,6 +2,8 @@
 
 Sample bot that returns interleaved results from GPT-3.5-Turbo and Claude-instant.
 
+Use BotComparisonBot to compare any list of bots, with per-bot latency stats.
+
 """
 
 from __future__ import annotations
@@ -9,12 +11,16 @@ from __future__ import annotations
 import asyncio
 import os
 import re
-from collections import defaultdict
-from typing import AsyncIterable, AsyncIterator
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, AsyncIterator, Optional, Sequence
 
 import fastapi_poe as fp
 from modal import App, Image, asgi_app
 
+from stream_utils import merge_streams
+
 # TODO: set your bot access key and bot name for this bot to work
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
@@ -22,114 +28,276 @@ bot_name = ""
 
 
 async def combine_streams(
-    *streams: AsyncIterator[fp.PartialResponse],
+    *streams: AsyncIterator[fp.PartialResponse], flush_interval: float = 0.1
 ) -> AsyncIterator[fp.PartialResponse]:
     """Combines a list of streams into one single response stream.
 
     Allows you to render multiple responses in parallel.
 
+    Each stream's chunks are buffered separately and the merged text is only re-rendered
+    (as a replace response) at most once every `flush_interval` seconds, plus a final flush
+    once all streams are done. Chunks that are still pending when the interval runs out are
+    flushed then, even if no stream produces anything else. The number of renders depends
+    on how long the streams take rather than on how many chunks they produce, so a stream
+    of many small chunks doesn't make the work and bytes sent grow quadratically with the
+    length of the output. Set `flush_interval` to 0 to re-render on every chunk.
+
     """
-    active_streams = {id(stream): stream for stream in streams}
-    responses: dict[int, list[str]] = defaultdict(list)
+    responses: dict[int, list[str]] = {index: [] for index in range(len(streams))}
+    queue: asyncio.Queue[
+        tuple[Optional[int], Optional[fp.PartialResponse], Optional[Exception]]
+    ] = asyncio.Queue()
 
-    async def _advance_stream(
-        stream_id: int, gen: AsyncIterator[fp.PartialResponse]
-    ) -> tuple[int, fp.PartialResponse | None]:
+    def _render() -> fp.PartialResponse:
+        text = "\n\n".join("".join(chunks) for chunks in responses.values() if chunks)
+        return fp.PartialResponse(text=text, is_replace_response=True)
+
+    async def _pump() -> None:
+        # Moves the merged chunks to a queue, which can be waited on with a timeout.
         try:
-            return stream_id, await gen.__anext__()
-        except StopAsyncIteration:
-            return stream_id, None
-
-    while active_streams:
-        for coro in asyncio.as_completed(
-            [
-                _advance_stream(stream_id, gen)
-                for stream_id, gen in active_streams.items()
-            ]
-        ):
-            stream_id, msg = await coro
-            if msg is None:
-                del active_streams[stream_id]
+            async for stream_index, msg in merge_streams(*streams):
+                await queue.put((stream_index, msg, None))
+        except Exception as e:
+            await queue.put((None, None, e))
+        else:
+            await queue.put((None, None, None))
+
+    loop = asyncio.get_running_loop()
+    pump = asyncio.ensure_future(_pump())
+    pending = False
+    last_flush = float("-inf")
+    try:
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0.0, last_flush + flush_interval - loop.time())
+            try:
+                stream_index, msg, error = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield _render()
+                pending = False
+                last_flush = loop.time()
                 continue
 
-            if isinstance(msg, fp.MetaResponse):
+            if error is not None:
+                raise error
+            elif stream_index is None or msg is None:
+                break
+            elif isinstance(msg, fp.MetaResponse):
                 continue
             elif msg.is_suggested_reply:
                 yield msg
                 continue
             elif msg.is_replace_response:
-                responses[stream_id] = [msg.text]
+                responses[stream_index] = [msg.text]
             else:
-                responses[stream_id].append(msg.text)
+                responses[stream_index].append(msg.text)
+
+            pending = True
+            now = loop.time()
+            if now - last_flush >= flush_interval:
+                yield _render()
+                pending = False
+                last_flush = now
+    finally:
+        pump.cancel()
+        await asyncio.gather(pump, return_exceptions=True)
+
+    if pending:
+        yield _render()
+
+
+STATS_HEADER = "\n\n---\n**Latency stats**\n"
+# The same rough estimate as tool_history.estimate_tokens.
+CHARS_PER_TOKEN = 4
+
+
+@dataclass
+class StreamStats:
+    """Latency stats for one bot, recorded while its response is streamed."""
+
+    bot: str
+    start_time: float = field(default_factory=time.monotonic)
+    first_token_time: Optional[float] = None
+    end_time: Optional[float] = None
+    num_chars: int = 0
+
+    def record_chunk(self, text: str) -> None:
+        if not text:
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.monotonic()
+        self.num_chars += len(text)
+
+    def render(self) -> str:
+        if self.first_token_time is None or self.end_time is None:
+            return f"| {self.bot} | - | - | - |"
+        ttft = self.first_token_time - self.start_time
+        total = self.end_time - self.start_time
+        generation_time = self.end_time - self.first_token_time
+        # Chunks can hold any number of tokens, so tokens are estimated from the text.
+        num_tokens = self.num_chars / CHARS_PER_TOKEN
+        tokens_per_second = num_tokens / generation_time if generation_time > 0 else 0.0
+        return f"| {self.bot} | {ttft:.2f}s | {total:.2f}s | {tokens_per_second:.1f} |"
+
+
+def render_stats_footer(stats: Sequence[StreamStats]) -> str:
+    rows = "\n".join(bot_stats.render() for bot_stats in stats)
+    return (
+        f"{STATS_HEADER}\n"
+        "| Bot | Time to first token | Total time | Est. tokens/s |\n"
+        "| --- | --- | --- | --- |\n"
+        f"{rows}\n"
+    )
 
-            text = "\n\n".join(
-                "".join(chunks) for stream_id, chunks in responses.items()
-            )
-            yield fp.PartialResponse(text=text, is_replace_response=True)
 
+BOT_SECTION_PATTERN = re.compile(r"\*\*([A-Za-z_\-\d.]+)\*\* says:\n")
+MAX_CACHED_MESSAGES = 4096
 
-def preprocess_message(message: fp.ProtocolMessage, bot: str) -> fp.ProtocolMessage:
+# Past messages never change, so their parsed sections are cached by message id.
+_bot_sections_cache: OrderedDict[str, dict[str, str]] = OrderedDict()
+
+
+def parse_bot_sections(message: fp.ProtocolMessage) -> dict[str, str]:
+    """Splits a bot message into a map from casefolded bot name to that bot's text."""
+    if message.message_id:
+        cached = _bot_sections_cache.get(message.message_id)
+        if cached is not None:
+            _bot_sections_cache.move_to_end(message.message_id)
+            return cached
+
+    content = message.content.split(STATS_HEADER, 1)[0]
+    parts = BOT_SECTION_PATTERN.split(content)
+    sections: dict[str, str] = {}
+    for message_bot, text in zip(parts[1::2], parts[2::2]):
+        sections.setdefault(message_bot.casefold(), text)
+
+    if message.message_id:
+        _bot_sections_cache[message.message_id] = sections
+        if len(_bot_sections_cache) > MAX_CACHED_MESSAGES:
+            _bot_sections_cache.popitem(last=False)
+    return sections
+
+
+def parse_query_sections(
+    query: Sequence[fp.ProtocolMessage],
+) -> list[Optional[dict[str, str]]]:
+    """Parses every bot message in the query once, to be shared by all compared bots."""
+    return [
+        parse_bot_sections(message) if message.role == "bot" else None
+        for message in query
+    ]
+
+
+def preprocess_message(
+    message: fp.ProtocolMessage, bot: str, sections: Optional[dict[str, str]] = None
+) -> fp.ProtocolMessage:
     """Process bot responses to keep only the parts that come from the given bot."""
     if message.role == "bot":
-        parts = re.split(r"\*\*([A-Za-z_\-\d]+)\*\* says:\n", message.content)
-        for message_bot, text in zip(parts[1::2], parts[2::2]):
-            if message_bot.casefold() == bot.casefold():
-                return message.model_copy(update={"content": text})
+        if sections is None:
+            sections = parse_bot_sections(message)
+        text = sections.get(bot.casefold())
+        if text is not None:
+            return message.model_copy(update={"content": text})
         # If we can't find a message by this bot, just return the original message
         return message
     else:
         return message
 
 
-def preprocess_query(request: fp.QueryRequest, bot: str) -> fp.QueryRequest:
-    """Parses the two bot responses and keeps the one for the current bot."""
+def preprocess_query(
+    request: fp.QueryRequest,
+    bot: str,
+    query_sections: Optional[Sequence[Optional[dict[str, str]]]] = None,
+) -> fp.QueryRequest:
+    """Parses the bot responses and keeps the one for the current bot."""
+    if query_sections is None:
+        query_sections = parse_query_sections(request.query)
     new_query = request.model_copy(
         update={
-            "query": [preprocess_message(message, bot) for message in request.query]
+            "query": [
+                preprocess_message(message, bot, sections)
+                for message, sections in zip(request.query, query_sections)
+            ]
         }
     )
     return new_query
 
 
 async def stream_request_wrapper(
-    request: fp.QueryRequest, bot: str
+    request: fp.QueryRequest,
+    bot: str,
+    stats: Optional[StreamStats] = None,
+    query_sections: Optional[Sequence[Optional[dict[str, str]]]] = None,
 ) -> AsyncIterator[fp.PartialResponse]:
-    """Wraps stream_request and labels the bot response with the bot name."""
+    """Wraps stream_request and labels the bot response with the bot name.
+
+    If `stats` is given, it is updated with the latency of the bot as it streams.
+    `query_sections` can be passed in from `parse_query_sections` to avoid re-parsing the
+    history for every bot.
+
+    """
     label = fp.PartialResponse(
         text=f"**{bot.title()}** says:\n", is_replace_response=True
     )
     yield label
-    async for msg in fp.stream_request(
-        preprocess_query(request, bot), bot, request.access_key
-    ):
-        if isinstance(msg, Exception):
-            yield fp.PartialResponse(
-                text=f"**{bot.title()}** ran into an error", is_replace_response=True
-            )
-            return
-        elif msg.is_replace_response:
-            yield label
-        # Force replace response to False since we are already explicitly handling that case above.
-        yield msg.model_copy(update={"is_replace_response": False})
+    try:
+        async for msg in fp.stream_request(
+            preprocess_query(request, bot, query_sections), bot, request.access_key
+        ):
+            if isinstance(msg, Exception):
+                yield fp.PartialResponse(
+                    text=f"**{bot.title()}** ran into an error",
+                    is_replace_response=True,
+                )
+                return
+            elif msg.is_replace_response:
+                yield label
+            if stats is not None:
+                stats.record_chunk(msg.text)
+            # Force replace response to False since we are already explicitly handling
+            # that case above.
+            yield msg.model_copy(update={"is_replace_response": False})
+    finally:
+        if stats is not None:
+            stats.end_time = time.monotonic()
 
 
-class GPT35TurbovsClaudeBot(fp.PoeBot):
+class BotComparisonBot(fp.PoeBot):
+    """Streams the responses of several bots side by side, followed by latency stats."""
+
+    def __init__(
+        self, bots: Sequence[str], *, show_stats: bool = True, **kwargs: Any
+    ) -> None:
+        super().__init__(**kwargs)
+        self.bots = list(bots)
+        self.show_stats = show_stats
+
     async def get_response(
         self, request: fp.QueryRequest
     ) -> AsyncIterable[fp.PartialResponse]:
+        stats = [StreamStats(bot=bot) for bot in self.bots]
+        query_sections = parse_query_sections(request.query)
         streams = [
-            stream_request_wrapper(request, bot)
-            for bot in ("GPT-3.5-Turbo", "Claude-3.5-Haiku")
+            stream_request_wrapper(request, bot, bot_stats, query_sections)
+            for bot, bot_stats in zip(self.bots, stats)
         ]
         async for msg in combine_streams(*streams):
             yield msg
+        if self.show_stats:
+            yield fp.PartialResponse(text=render_stats_footer(stats))
 
     async def get_settings(self, setting: fp.SettingsRequest) -> fp.SettingsResponse:
         return fp.SettingsResponse(
-            server_bot_dependencies={"GPT-3.5-Turbo": 1, "Claude-3.5-Haiku": 1}
+            server_bot_dependencies={bot: 1 for bot in self.bots}
         )
 
 
+class GPT35TurbovsClaudeBot(BotComparisonBot):
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(bots=["GPT-3.5-Turbo", "Claude-3.5-Haiku"], **kwargs)
+
+
 REQUIREMENTS = ["fastapi-poe"]
 image = (
     Image.debian_slim()
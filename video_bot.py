@@ -1,30 +1,40 @@
 from __future__ import annotations
 
 import os
-from typing import AsyncIterable
+from typing import AsyncIterable, Optional
 
 import fastapi_poe as fp
 from modal import App, Image, Mount, asgi_app
 
+from asset_manager import AssetManager
+from attachment_upload import StreamingUploadBot
+
 # TODO: set your bot access key and bot name for full functionality
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
 bot_access_key = os.getenv("POE_ACCESS_KEY")
 bot_name = ""
 
+ASSETS_DIR = "/root/assets"
+VIDEO_FILENAME = "tiger.mp4"
+
+
+class VideoBot(StreamingUploadBot):
+    # Set when the app starts up (see `fastapi_app` below) and shared by all requests.
+    asset_manager: Optional[AssetManager] = None
 
-class VideoBot(fp.PoeBot):
     async def get_response(
         self, request: fp.QueryRequest
     ) -> AsyncIterable[fp.PartialResponse]:
-        with open("/root/assets/tiger.mp4", "rb") as file:
-            file_data = file.read()
-        await self.post_message_attachment(
-            message_id=request.message_id, file_data=file_data, filename="tiger.mp4"
+        if self.asset_manager is None:
+            self.asset_manager = AssetManager(ASSETS_DIR)
+        await self.asset_manager.post_attachment(
+            self, request.message_id, VIDEO_FILENAME
         )
         yield fp.PartialResponse(text="Attached a video.")
 
 
-REQUIREMENTS = ["fastapi-poe"]
+# StreamingUploadBot needs the _upload_file hook of fastapi-poe 0.0.82 and later.
+REQUIREMENTS = ["fastapi-poe==0.0.83"]
 image = (
     Image.debian_slim()
     .pip_install(*REQUIREMENTS)
@@ -43,10 +53,18 @@ app = App(
 @asgi_app()
 def fastapi_app():
     bot = VideoBot()
+    # Hash the video once, when the container starts.
+    bot.asset_manager = AssetManager(ASSETS_DIR)
+    bot.asset_manager.load(VIDEO_FILENAME)
     app = fp.make_app(
         bot,
         access_key=bot_access_key,
         bot_name=bot_name,
         allow_without_key=not (bot_access_key and bot_name),
     )
+
+    @app.get("/asset_stats")
+    async def asset_stats() -> dict:
+        return bot.asset_manager.stats() if bot.asset_manager is not None else {}
+
     return app
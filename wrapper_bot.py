@@ -7,11 +7,14 @@ Sample bot that wraps OpenAI async API.
 from __future__ import annotations
 
 import os
-from typing import AsyncIterable
+from contextlib import asynccontextmanager
+from typing import AsyncIterable, AsyncIterator, Optional
 
 import fastapi_poe as fp
+from fastapi import FastAPI
 from modal import App, Image, asgi_app
-from openai import AsyncOpenAI
+
+from openai_provider import DeadlineExceededError, OpenAIProvider
 
 # TODO: set your bot access key, and openai api key, and bot name for this bot to work
 # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
@@ -19,10 +22,8 @@ bot_access_key = os.getenv("POE_ACCESS_KEY")
 openai_api_key = os.getenv("OPENAI_API_KEY")
 bot_name = ""
 
-client = AsyncOpenAI()
-
 
-async def stream_chat_completion(request: fp.QueryRequest):
+async def stream_chat_completion(provider: OpenAIProvider, request: fp.QueryRequest):
     messages = []
     # this is a demo bot, the messages and message length will be truncated
     for query in request.query[-5:]:
@@ -35,25 +36,28 @@ async def stream_chat_completion(request: fp.QueryRequest):
         else:
             raise
 
-    response = await client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        temperature=1.0,
-        stream=True,
-        max_tokens=50,
-    )
-
-    async for chunk in response:
-        if chunk.choices[0].delta.content:
-            yield fp.PartialResponse(text=chunk.choices[0].delta.content)
+    async for text in provider.stream_chat_completion(
+        model="gpt-4o-mini", messages=messages, temperature=1.0, max_tokens=50
+    ):
+        yield fp.PartialResponse(text=text)
 
 
 class WrapperBot(fp.PoeBot):
+    # Set when the app starts up (see `fastapi_app` below) and shared by all requests.
+    provider: Optional[OpenAIProvider] = None
+
     async def get_response(
         self, request: fp.QueryRequest
     ) -> AsyncIterable[fp.PartialResponse]:
-        async for msg in stream_chat_completion(request):
-            yield msg
+        if self.provider is None:
+            self.provider = OpenAIProvider()
+        try:
+            async for msg in stream_chat_completion(self.provider, request):
+                yield msg
+        except DeadlineExceededError:
+            yield fp.ErrorResponse(
+                text="The model did not finish responding in time.", allow_retry=True
+            )
 
 
 REQUIREMENTS = ["fastapi-poe", "openai"]
@@ -69,10 +73,26 @@ app = App("wrapper-bot-poe")
 @asgi_app()
 def fastapi_app():
     bot = WrapperBot()
+
+    @asynccontextmanager
+    async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+        bot.provider = OpenAIProvider()
+        try:
+            yield
+        finally:
+            await bot.provider.aclose()
+            bot.provider = None
+
     app = fp.make_app(
         bot,
         access_key=bot_access_key,
         bot_name=bot_name,
         allow_without_key=not (bot_access_key and bot_name),
+        app=FastAPI(lifespan=lifespan),
     )
+
+    @app.get("/provider_stats")
+    async def provider_stats() -> dict:
+        return bot.provider.stats if bot.provider is not None else {}
+
     return app